@@ -0,0 +1,261 @@
+"""Headless batch matching: run jobs described in a JSON or YAML file.
+
+Each job gives a lattice, family or element variables, constraints in the
+same format as Constraints, and options, e.g.:
+
+    {"defaults": {"options": {"jac": "analytic", "ftol": 1e-10}},
+     "jobs": [{"name": "tunes",
+               "lattice": "../atip/atip/rings/for_Tobyn.lat",
+               "variables": [{"family": "qf1", "field": ["PolynomB", 1]},
+                             {"family": "qd2", "field": ["PolynomB", 1],
+                              "lower": -3.0, "upper": 0.0}],
+               "constraints": {"tune_x": [[], [0.36], [2]],
+                               "tune_y": [[], [0.64], [1]]}}]}
+
+Variables take either a "family" name or an element "index", a "field" (a
+name, or a name and a cell), and optionally a starting "value", by default
+the lattice's, and "lower" and "upper" bounds. Lattices are loaded by file
+extension, .lat by at.load_tracy and .mat by at.load_mat, through the
+on-disk cache in lattice_cache.py, or generated by benchmark.py if given
+as {"generator": "fodo", "n_elements": 1000}. The "method" option picks
+Optimizer.run ('least_squares', the default), run_linear ('linear') or
+run_global ('global'); the "incremental", "closed_orbit", "cache_size" and
+"superperiods" options go to Constraints and the rest to the method. When
+jobs run in a pool of worker processes each job runs in its own worker,
+with "processes" set to 1 and the 'parallel' Jacobian replaced by
+'2-point'.
+One JSON line of results (values, residuals, achieved constraints, timings)
+is written per job as it finishes, e.g.:
+
+    python batch.py jobs.json --processes 8 --output results.jsonl
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import numpy
+import benchmark
+import lattice_cache
+import optimizer as o
+
+try:
+    import yaml
+except ImportError:  # YAML job files are optional
+    yaml = None
+
+CONSTRAINT_OPTIONS = ['incremental', 'closed_orbit', 'cache_size',
+                      'superperiods']
+METHODS = {'least_squares': 'run', 'linear': 'run_linear',
+           'global': 'run_global'}
+
+
+def load_jobs(path):
+    """Return the list of jobs in a JSON or YAML job file, with the file's
+    "defaults" merged into each, and unnamed jobs named by their position.
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError("PyYAML is needed to read YAML job files.")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    defaults = spec.get('defaults', {})
+    jobs = []
+    for n, job in enumerate(spec['jobs']):
+        merged = dict(defaults, **job)
+        merged['options'] = dict(defaults.get('options', {}),
+                                 **job.get('options', {}))
+        merged.setdefault('name', 'job{0}'.format(n))
+        jobs.append(merged)
+    return jobs
+
+
+def load_lattice(source):
+    """Load, or generate, the lattice a job gives.
+    """
+    if isinstance(source, dict):
+        generator = benchmark.LATTICES[source['generator']][0]
+        return generator(source.get('n_elements', 1000))
+    if source.endswith(('.lat', '.mat')):
+        return lattice_cache.load(source)
+    raise ValueError("Unknown lattice format {0}, use .lat or .mat."
+                     .format(source))
+
+
+def make_variables(lattice, specs):
+    """Return the Variables object for a job's variable specifications.
+    """
+    fields, indices, values, lower, upper = [], [], [], [], []
+    for spec in specs:
+        field = spec['field']
+        if not isinstance(field, str):
+            field = tuple(field)
+        if 'family' in spec:
+            index = spec['family']
+            elements = lattice.get_elements(index)
+            if not elements:
+                raise KeyError("No elements found in family {0}."
+                               .format(index))
+            element = elements[0]
+        else:
+            index = int(spec['index'])
+            element = lattice[index]
+        if 'value' in spec:
+            value = spec['value']
+        elif isinstance(field, str):
+            value = vars(element)[field]
+        else:
+            value = vars(element)[field[0]][field[1]]
+        fields.append(field)
+        indices.append(index)
+        values.append(float(value))
+        lower.append(spec.get('lower', -numpy.inf))
+        upper.append(spec.get('upper', numpy.inf))
+    return o.Variables(fields, indices, values, lower, upper)
+
+
+def run_job(job):
+    """Run one job and return its results as a dictionary; a job that fails
+    is reported with its error rather than raised.
+    """
+    record = {'name': job['name'], 'status': 'ok'}
+    try:
+        with contextlib.redirect_stdout(sys.stderr):  # keep stdout for JSON
+            start = time.time()
+            lattice = load_lattice(job['lattice'])
+            record['load_time'] = time.time() - start
+            options = dict(job['options'])
+            method = METHODS[options.pop('method', 'least_squares')]
+            cons_options = {key: options.pop(key)
+                            for key in CONSTRAINT_OPTIONS if key in options}
+            if multiprocessing.current_process().daemon:
+                # Pool workers can't start processes of their own, so the
+                # job runs in this one; the 'parallel' Jacobian's finite
+                # differences are then the same as '2-point's
+                if method != 'run_linear':
+                    options['processes'] = 1
+                if options.get('jac') == 'parallel':
+                    options['jac'] = '2-point'
+            constraints = o.Constraints(lattice, job['constraints'],
+                                        **cons_options)
+            variables = make_variables(lattice, job['variables'])
+            optimizer = o.Optimizer(constraints, variables)
+            values = getattr(optimizer, method)(return_values=True, **options)
+            lindata, residuals = constraints.evaluate(values, variables)
+        record.update({
+            'values': values, 'residuals': residuals,
+            'cost': 0.5 * numpy.dot(residuals, residuals),
+            'achieved': ({} if lindata is None else
+                         constraints.convert_lindata(lindata)),
+            'wall_time': optimizer.wall_time,
+            'nfev': getattr(optimizer, 'nfev', None),
+            'n_linopt': getattr(optimizer, 'n_linopt', None)
+        })
+        result = getattr(optimizer, 'result', None)
+        if result is not None:
+            record['success'] = bool(result.success)
+            record['message'] = str(result.message)
+        stats = getattr(optimizer, 'stats', None)
+        if stats is not None:
+            record['stages'] = {stage: {'count': s['count'],
+                                        'total': s['total']}
+                                for stage, s in stats.stages.items()}
+    except Exception as error:
+        record['status'] = 'error'
+        record['error'] = repr(error)
+        record['traceback'] = traceback.format_exc()
+    return record
+
+
+def _json_default(obj):
+    if hasattr(obj, 'tolist'):  # numpy arrays and scalars
+        return obj.tolist()
+    return str(obj)
+
+
+def completed_jobs(path):
+    """Return the names of the jobs that finished without error in an
+    existing results file.
+    """
+    names = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short when the run was killed
+                if record.get('status') == 'ok':
+                    names.add(record['name'])
+    return names
+
+
+def run_jobs(jobs, processes=None, output=None, resume=False,
+             callback=None):
+    """Run the jobs in a pool of processes worker processes, by default one
+    per CPU, or in this process if processes is 1, writing each result as a
+    JSON line to output (a file path, appended to, or stdout if None) as it
+    finishes, and returning the results. If resume is True, jobs that
+    already finished without error in output are skipped. If given,
+    callback is called with each result.
+    """
+    if resume and (output is not None):
+        done = completed_jobs(output)
+        jobs = [job for job in jobs if job['name'] not in done]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    stream = sys.stdout if output is None else open(output, 'a')
+    pool = None
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        finished = pool.imap_unordered(run_job, jobs)
+    else:
+        finished = (run_job(job) for job in jobs)
+    records = []
+    try:
+        for record in finished:
+            stream.write(json.dumps(record, default=_json_default) + '\n')
+            stream.flush()
+            records.append(record)
+            if callback is not None:
+                callback(record)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if output is not None:
+            stream.close()
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('jobs', help='JSON or YAML job file')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--output', default=None,
+                        help='JSON lines file to append results to, '
+                             'default stdout')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip jobs already finished in the output')
+    args = parser.parse_args(argv)
+    records = run_jobs(load_jobs(args.jobs), args.processes, args.output,
+                       args.resume)
+    failed = [record['name'] for record in records
+              if record['status'] != 'ok']
+    if failed:
+        sys.stderr.write("{0} of {1} jobs failed: {2}\n"
+                         .format(len(failed), len(records),
+                                 ', '.join(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
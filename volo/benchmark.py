@@ -0,0 +1,278 @@
+"""Benchmark suite of reference matching problems on synthetic lattices.
+
+The problems are modelled on those in examples.py, tune matching (example1)
+and beta minimisation (example2), but run on generated FODO and DBA rings so
+that no external lattice file is needed and the size of the lattice can be
+varied, from 100 to 100k elements. Each problem is run in a fresh process and
+its wall time, number of function evaluations, time per merit function call
+and peak memory are reported as JSON, e.g.:
+
+    python benchmark.py --sizes 100 1000 --output results.json
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import queue
+import sys
+import time
+
+import at
+import numpy
+import scipy
+import optimizer as o
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def _n_cells(n_elements, cell_size):
+    return max(1, int(round(n_elements / float(cell_size))))
+
+
+def _cell_angle(n_cells):
+    """Return the bending angle of each of the two dipoles in a cell; it is
+    never more than that of a 32 cell ring, so that small rings remain stable
+    (they are then an arc of a larger ring, with periodic optics).
+    """
+    return 2 * numpy.pi / (2 * max(n_cells, 32))
+
+
+def fodo_ring(n_elements=1000, energy=3e9):
+    """Return a ring of about n_elements made of 12 element FODO cells, with
+    quadrupole families 'qf' and 'qd' and sextupole families 'sf' and 'sd'.
+    """
+    n_cells = _n_cells(n_elements, 12)
+    angle = _cell_angle(n_cells)
+    elements = []
+    for cell in range(n_cells):
+        elements += [at.Quadrupole('qf', 0.3, 0.9), at.Drift('d1', 0.5),
+                     at.Sextupole('sf', 0.1, 5.0), at.Drift('d2', 0.4),
+                     at.Dipole('b', 1.5, angle), at.Drift('d1', 0.5),
+                     at.Quadrupole('qd', 0.3, -0.9), at.Drift('d1', 0.5),
+                     at.Sextupole('sd', 0.1, -5.0), at.Drift('d2', 0.4),
+                     at.Dipole('b', 1.5, angle), at.Drift('d1', 0.5)]
+    return at.Lattice(elements, energy=energy, name='fodo')
+
+
+def dba_ring(n_elements=1000, energy=3e9):
+    """Return a ring of about n_elements made of 19 element double bend
+    achromat cells, with quadrupole families 'qd1', 'qf1' and 'qf2' and
+    sextupole families 'sf' and 'sd' between the dipoles.
+    """
+    n_cells = _n_cells(n_elements, 19)
+    angle = _cell_angle(n_cells)
+    elements = []
+    for cell in range(n_cells):
+        elements += [at.Drift('d1', 2.0), at.Quadrupole('qd1', 0.25, -1.4),
+                     at.Drift('d2', 0.3), at.Quadrupole('qf1', 0.3, 0.8),
+                     at.Drift('d3', 0.5),
+                     at.Dipole('b', 1.0, angle, EntranceAngle=angle / 2,
+                               ExitAngle=angle / 2),
+                     at.Drift('d4', 0.3), at.Sextupole('sd', 0.1, -8.0),
+                     at.Drift('d5', 0.2), at.Quadrupole('qf2', 0.3, 0.8),
+                     at.Drift('d5', 0.2), at.Sextupole('sf', 0.1, 8.0),
+                     at.Drift('d4', 0.3),
+                     at.Dipole('b', 1.0, angle, EntranceAngle=angle / 2,
+                               ExitAngle=angle / 2),
+                     at.Drift('d3', 0.5), at.Quadrupole('qf1', 0.3, 0.8),
+                     at.Drift('d2', 0.3), at.Quadrupole('qd1', 0.25, -1.4),
+                     at.Drift('d1', 2.0)]
+    return at.Lattice(elements, energy=energy, name='dba')
+
+
+# lattice name -> (generator, tune families, beta families, beta refpts)
+LATTICES = {'fodo': (fodo_ring, ['qf', 'qd'], ['qf', 'qd'], [1, 7]),
+            'dba': (dba_ring, ['qf1', 'qd1'], ['qd1', 'qf1', 'qf2'], [2, 9])}
+
+
+def _family_variables(lattice, families):
+    values = [lattice.get_elements(family)[0].PolynomB[1]
+              for family in families]
+    return o.Variables([['PolynomB', 1]] * len(families), families, values)
+
+
+def tune_problem(lattice, families):
+    """Match both fractional tunes, shifted by 0.01 towards 0.5 from their
+    initial values, with two quadrupole families, as in example1.
+    """
+    tune = at.linopt(lattice)[1]
+    target = tune + numpy.where(tune < 0.5, 0.01, -0.01)
+    constraints = {'tune_x': [[], [target[0]], [2]],
+                   'tune_y': [[], [target[1]], [1]]}
+    return constraints, _family_variables(lattice, families)
+
+
+def beta_problem(lattice, families, refpts):
+    """Reduce the horizontal beta function at two points to 80% of its
+    initial values with the given quadrupole families, as in example2.
+    """
+    beta = at.linopt(lattice, refpts=refpts)[3].beta[:, 0]
+    constraints = {'beta_x': [list(refpts), list(0.8 * beta),
+                              [1] * len(refpts)]}
+    return constraints, _family_variables(lattice, families)
+
+
+PROBLEMS = ['tune', 'beta']
+
+
+def _peak_memory():
+    """Return the peak resident set size of this process in bytes, or None
+    if it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_problem(lattice='fodo', n_elements=1000, problem='tune',
+                jac='2-point', incremental=False, max_iters=None):
+    """Build the named lattice and run the named problem on it, returning a
+    dictionary of the measurements. Peak memory is that of the whole process,
+    so is only meaningful when each problem is run in a fresh process, as
+    run_suite does.
+    """
+    generator, tune_families, beta_families, refpts = LATTICES[lattice]
+    start = time.time()
+    ring = generator(n_elements)
+    build_time = time.time() - start
+    if problem == 'tune':
+        constraints, variables = tune_problem(ring, tune_families)
+    elif problem == 'beta':
+        constraints, variables = beta_problem(ring, beta_families, refpts)
+    else:
+        raise KeyError("Unknown problem {0}, must be one of {1}."
+                       .format(problem, PROBLEMS))
+    cons = o.Constraints(ring, constraints, incremental=incremental)
+    optimizer = o.Optimizer(cons, variables)
+    merit = {'calls': 0, 'time': 0.0}
+
+    def timed(merit_function):
+        def merit_call(values, variables, **kwargs):
+            start = time.time()
+            try:
+                return merit_function(values, variables, **kwargs)
+            finally:
+                merit['calls'] += 1
+                merit['time'] += time.time() - start
+        return merit_call
+
+    optimizer.run(max_iters=max_iters, jac=jac, monitor=timed)
+    return {'lattice': lattice, 'n_elements': len(ring), 'problem': problem,
+            'jac': jac, 'incremental': incremental,
+            'build_time': build_time, 'wall_time': optimizer.wall_time,
+            'nfev': int(optimizer.nfev),
+            'njev': None if optimizer.njev is None else int(optimizer.njev),
+            'n_linopt': optimizer.n_linopt, 'n_merit': merit['calls'],
+            'time_per_merit': merit['time'] / max(merit['calls'], 1),
+            'peak_memory': _peak_memory(),
+            'cost': float(optimizer.result.cost),
+            'success': bool(optimizer.result.success)}
+
+
+def _run_child(results, kwargs):
+    sys.stdout = sys.stderr  # keep stdout for the JSON
+    try:
+        results.put(run_problem(**kwargs))
+    except Exception as error:
+        results.put(dict(kwargs, error=repr(error)))
+
+
+def _wait_for_result(child, results, kwargs, timeout=None, poll=1.0):
+    """Return the measurements the child process puts on results, or a
+    record of the failure if it exits without them, e.g. when it is killed
+    by the OOM killer, or if it runs for more than timeout seconds.
+    """
+    start = time.time()
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            pass
+        if child.exitcode is not None:
+            try:  # it may have put its result just before exiting
+                return results.get(timeout=poll)
+            except queue.Empty:
+                return dict(kwargs, error="Process exited with code {0} "
+                            "without a result.".format(child.exitcode))
+        if (timeout is not None) and (time.time() - start > timeout):
+            child.terminate()
+            return dict(kwargs, error="Timed out after {0} seconds."
+                        .format(timeout))
+
+
+def run_suite(lattices=None, sizes=(100, 1000, 10000, 100000), problems=None,
+              jacs=('2-point',), incremental=False, max_iters=None,
+              verbose=False, timeout=None):
+    """Run every combination of lattice, size, problem and Jacobian mode,
+    each in a fresh process, and return a dictionary of the environment
+    ('meta') and the list of measurements ('results'). The processes are
+    spawned rather than forked, so that their peak memory doesn't include
+    this process's. A problem that fails, whose process dies, or that runs
+    for more than timeout seconds is recorded with its error rather than
+    stopping the suite.
+    """
+    context = multiprocessing.get_context('spawn')
+    lattices = list(LATTICES) if lattices is None else lattices
+    problems = PROBLEMS if problems is None else problems
+    records = []
+    for lattice in lattices:
+        for size in sizes:
+            for problem in problems:
+                for jac in jacs:
+                    kwargs = {'lattice': lattice, 'n_elements': size,
+                              'problem': problem, 'jac': jac,
+                              'incremental': incremental,
+                              'max_iters': max_iters}
+                    results = context.Queue()
+                    child = context.Process(target=_run_child,
+                                            args=(results, kwargs))
+                    child.start()
+                    record = _wait_for_result(child, results, kwargs,
+                                              timeout)
+                    child.join()
+                    if verbose:
+                        print(json.dumps(record))
+                    records.append(record)
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': numpy.__version__, 'scipy': scipy.__version__,
+            'at': getattr(at, '__version__', None),
+            'cpu_count': multiprocessing.cpu_count()}
+    return {'meta': meta, 'results': records}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lattices', nargs='+', choices=list(LATTICES),
+                        default=list(LATTICES))
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[100, 1000, 10000, 100000])
+    parser.add_argument('--problems', nargs='+', choices=PROBLEMS,
+                        default=PROBLEMS)
+    parser.add_argument('--jac', nargs='+', default=['2-point'],
+                        choices=['2-point', '3-point', 'analytic', 'parallel'])
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--max-iters', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds before a problem is stopped')
+    parser.add_argument('--output', default=None,
+                        help='file to write the JSON to, default stdout')
+    args = parser.parse_args(argv)
+    suite = run_suite(args.lattices, args.sizes, args.problems, args.jac,
+                      args.incremental, args.max_iters,
+                      verbose=args.output is not None,
+                      timeout=args.timeout)
+    if args.output is None:
+        print(json.dumps(suite, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(suite, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,13 @@
 import at
 import numpy
 import atip.ease as e
+import lattice_cache
 import optimizer as o
 
 
 # Matching tunes using two quadrupole families:
 def example1():
-    lattice = at.load_tracy('../atip/atip/rings/for_Tobyn.lat')
+    lattice = lattice_cache.load('../atip/atip/rings/for_Tobyn.lat')
     for index, elem in enumerate(lattice):
         elem.Index = index
     qf1s = lattice.get_elements('qf1')
@@ -44,7 +45,7 @@ def example1():
 
 # Minimising the beta function at two given points:
 def example2():
-    lattice = at.load_tracy('../atip/atip/rings/for_Tobyn.lat')
+    lattice = lattice_cache.load('../atip/atip/rings/for_Tobyn.lat')
     qd2s = lattice.get_elements('qd2')
     qd5s = lattice.get_elements('qd5')
     qd3s = lattice.get_elements('qd3')
@@ -53,22 +54,15 @@ def example2():
     vals = [qd2s[0].PolynomB[1], qd5s[0].PolynomB[1], qd3s[0].PolynomB[1],
             qf1s[0].PolynomB[1], qf6s[0].PolynomB[1]]
 
-    # The generalisation from exapmle1 could be taken further e.g. using:
-    def edit_family(ring, ffc, value):
-        family, field, cell = ffc
-        for elem in ring.get_elements(family):
-            vars(elem)[field][cell] = value
-
-    variables = o.Variables(
-        [edit_family, edit_family, edit_family, edit_family, edit_family],
-        [('qd2', 'PolynomB', 1), ('qd5', 'PolynomB', 1), ('qd3', 'PolynomB', 1),
-         ('qf1', 'PolynomB', 1), ('qf6', 'PolynomB', 1)],
-        vals
-    )
+    # The generalisation from exapmle1 is built in; passing a family name as
+    # the index changes every element of the family, found only once rather
+    # than on every evaluation, and allows an analytic Jacobian:
+    variables = o.Variables([['PolynomB', 1]] * 5,
+                            ['qd2', 'qd5', 'qd3', 'qf1', 'qf6'], vals)
     constraints = o.Constraints(lattice,
                                 {'beta_x': [[141, 250], [0.4, 0.4], [1, 1]]})
     optimizer = o.Optimizer(constraints, variables)
-    return optimizer.run(verbosity=1)
+    return optimizer.run(verbosity=1, jac='analytic')
 
 example1()
 example2()
@@ -1,33 +1,38 @@
+import copy
 import os
 import sys
 from collections import OrderedDict
 
 import at
-import at.plot
-import atip
-import math
 import numpy
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
-from PyQt5.QtCore import Qt, QMargins, QMimeData, QEvent
+from PyQt5.QtCore import (Qt, QMargins, QMimeData, QEvent, QObject, QRect,
+                          QThread, QTimer, pyqtSignal)
 from PyQt5.QtGui import QPainter, QDrag, QDoubleValidator, QValidator
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QGroupBox, QWidget,
                              QVBoxLayout, QHBoxLayout, QLabel, QGridLayout,
                              QLineEdit, QComboBox)
 
+import lattice_cache
+import radiation
+from incremental import IncrementalOptics, has_orbit_sources
+
 
 class Window(QMainWindow):
     """Class for the whole window.
     """
+    # Asks the calculation worker to recalculate, with the edit generation
+    # and the edits made since it was last asked
+    calculate = pyqtSignal(int, object)
+
     def __init__(self, parent=None):
         """Load and initialise the lattices.
         """
         super(Window, self).__init__(parent)
-        # Lattice loading
-        ring = atip.utils.load_at_lattice('DIAD')
-        sp_len = ring.circumference/6.0
-        ring.s_range = [0, sp_len]
-        self.lattice = ring[ring.i_range[0]:ring.i_range[-1]]# + [ring[1491]]
+        # Lattice loading, the whole ring is shown, zoomed by set_view; on a
+        # warm start its initial optics are memory-mapped from the cache
+        self.lattice, initial = lattice_cache.load_atip('DIAD', optics=True)
         """
         self.lattice = at.load_tracy('../atip/atip/rings/for_Tobyn.lat')
         zl = []
@@ -40,14 +45,24 @@ class Window(QMainWindow):
             self.lattice.__delitem__(idx)
         print(len(self.lattice))
         """
-        self._atsim = atip.simulator.ATSimulator(self.lattice, emit_calc=False)
-        self.s_selection = None
+        self.s_selection = None  # the selected s position, if any
 
         # Super-period support
         self.total_len = self.lattice.get_s_pos(len(self.lattice))[0]
-        self.symmetry = 6
+        self.symmetry = 1  # the whole ring is simulated
         #self.symmetry = vars(self.lattice).get('periodicity', 1)
 
+        # Zoom and pan, the visible section of the lattice is view
+        self.view = (0.0, self.total_len)
+        self.min_span = min(1.0, self.total_len)
+        self.zoom_factor = 1.25  # per wheel step
+        self.pan_start = None
+
+        # Initial optics, later recalculated in the background after edits
+        self.optics_data, self.lattice_data = calc_optics(self.lattice,
+                                                          initial)
+        self.init_calc_thread()
+
         # Create UI
         self.initUI()
 
@@ -67,8 +82,14 @@ class Window(QMainWindow):
         self.figure = Figure()
         self.canvas = FigureCanvasQTAgg(self.figure)
         self.canvas.mpl_connect('button_press_event', self.graph_onclick)
-        self.figure.set_tight_layout({"pad": 0.5, "w_pad": 0, "h_pad": 0})
-        self.plot()
+        self.canvas.mpl_connect('draw_event', self.cache_background)
+        self.canvas.mpl_connect('motion_notify_event', self.graph_onhover)
+        self.canvas.mpl_connect('axes_leave_event', self.graph_onleave)
+        self.canvas.mpl_connect('scroll_event', self.graph_onscroll)
+        self.canvas.mpl_connect('button_release_event', self.graph_onrelease)
+        self.canvas.mpl_connect('resize_event', self.update_layout)
+        self.create_plot()
+        self.update_layout()
         # Make graph fixed size to prevent autoscaling
         self.canvas.setMinimumWidth(1000)
         self.canvas.setMaximumWidth(1000)
@@ -81,69 +102,30 @@ class Window(QMainWindow):
         # Add graph to left side layout
         self.left_side.addLayout(graph)
 
-        # Create lattice representation bar
-        self.full_disp = QVBoxLayout()
-        self.full_disp.setSpacing(0)
-        self.lat_disp = QHBoxLayout()
-        self.lat_disp.setSpacing(0)
-        self.lat_disp.setContentsMargins(QMargins(0, 0, 0, 0))
-        # Add a stretch at both ends to keep the lattice representation centred
-        self.lat_disp.addStretch()
-        # Add startline
-        self.lat_disp.addWidget(element_repr(-1, Qt.black, 1, drag=False))
-        # Add elements
-        self.lat_repr = self.create_lat_repr()
-        for el_repr in self.lat_repr:
-            self.lat_disp.addWidget(el_repr)
-        # Add endline
-        self.lat_disp.addWidget(element_repr(-1, Qt.black, 1, drag=False))
-        # Add offset
-        self.lat_disp.addWidget(element_repr(-1, Qt.white, 3, drag=False))
+        # Create lattice representation strip
+        self.strip_disp = QHBoxLayout()
+        self.strip_disp.setSpacing(0)
+        self.strip_disp.setContentsMargins(QMargins(0, 0, 0, 0))
         # Add a stretch at both ends to keep the lattice representation centred
-        self.lat_disp.addStretch()
-        # Add non-zero length representation to lattice representation layout
-        self.full_disp.addLayout(self.lat_disp)
-
-        # Add horizontal dividing line
-        self.black_bar = QHBoxLayout()
-        self.black_bar.setSpacing(0)
-        self.black_bar.addStretch()  # Keep it centred
-        self.mid_line = element_repr(-1, Qt.black, 1000, height=1, drag=False)
-        self.black_bar.addWidget(self.mid_line)
+        self.strip_disp.addStretch()
+        self.strip = lattice_strip(self.lattice)
+        self.strip.set_positions(self.optics_data['s_pos'])
+        self.strip.set_view(*self.view)
+        self.strip.scrolled.connect(self.scroll_view)
+        self.strip.setFixedWidth(1000 - 125)
+        self.strip_disp.addWidget(self.strip)
         # Add offset
-        self.black_bar.addWidget(element_repr(-1, Qt.white, 3, height=1,
-                                              drag=False))
-        self.black_bar.addStretch()  # Keep it centred
-        self.full_disp.addLayout(self.black_bar)
-
-        # Create zero length element representation bar
-        self.zl_disp = QHBoxLayout()
-        self.zl_disp.setSpacing(0)
-        # Add a stretch at both ends to keep the lattice representation centred
-        self.zl_disp.addStretch()
-        # Add startline
-        self.zl_disp.addWidget(element_repr(-1, Qt.black, 1, drag=False))
-        # Add elements
-        self.zl_repr = self.calc_zero_len_repr(1000)
-        for el_repr in self.zl_repr:
-            self.zl_disp.addWidget(el_repr)
-        # Add endline
-        self.zl_disp.addWidget(element_repr(-1, Qt.black, 1, drag=False))
-        # Add offset
-        self.zl_disp.addWidget(element_repr(-1, Qt.white, 3, drag=False))
-        # Add a stretch at both ends to keep the lattice representation centred
-        self.zl_disp.addStretch()
-        # Add zero length representation to lattice representation layout
-        self.full_disp.addLayout(self.zl_disp)
-        # Add full lattice representation to left side layout
-        self.left_side.addLayout(self.full_disp)
+        self.strip_disp.addSpacing(3)
+        self.strip_disp.addStretch()
+        # Add lattice representation to left side layout
+        self.left_side.addLayout(self.strip_disp)
 
         # Create element editing boxes to drop to
         bottom = QHBoxLayout()
         self.edit_boxes = []
         # Future possibility to auto determine number of boxes by window size
         for i in range(4):
-            box = edit_box(self, self._atsim)
+            box = edit_box(self)
             self.edit_boxes.append(box)
             bottom.addWidget(box)
         # Add edit boxes to left side layout
@@ -176,7 +158,7 @@ class Window(QMainWindow):
         self.lattice_data_widgets = {}
         row_count = 1  # start after global title row
         # Create global fields
-        for field, value in self.get_lattice_data().items():
+        for field, value in self.lattice_data.items():
             sidebar.addWidget(QLabel("{0}: ".format(field)), row_count, 0)
             lab = QLabel(self.stringify(value))
             sidebar.addWidget(lab, row_count, 1)
@@ -216,167 +198,162 @@ class Window(QMainWindow):
         wid.setLayout(layout)
         self.setCentralWidget(wid)
         self.setStyleSheet("background-color:white;")
+        # Hover readout of the local optics under the mouse
+        self.hover_label = QLabel("")
+        self.hover_label.setStyleSheet("font-family:monospace;")
+        self.statusBar().addPermanentWidget(self.hover_label)
+        self.statusBar().showMessage("Ready")
         self.show()
 
-    def create_lat_repr(self):
-        """Create a list of element representations, in the order that they
-        appear in the lattice, colour coded according to their type.
-        See also: calc_zero_len_repr
-        """
-        lat_repr = []
-        self.zero_length = []
-        self.base_widths = []
-        for elem in self.lattice:#[:self.lattice.i_range[-1]]:
-            width = math.ceil(elem.Length)
-            if width == 0:
-                if not (isinstance(elem, at.elements.Drift) or
-                        isinstance(elem, at.elements.Marker) or
-                        isinstance(elem, at.elements.Aperture)):
-                    # don't care about zero length drifts, markers or apertures
-                    self.zero_length.append(elem)
-            else:
-                self.base_widths.append(elem.Length)
-                if isinstance(elem, at.elements.Drift):
-                    elem_repr = element_repr(elem.Index, Qt.white, width)
-                elif isinstance(elem, at.elements.Dipole):
-                    elem_repr = element_repr(elem.Index, Qt.green, width)
-                elif isinstance(elem, at.elements.Quadrupole):
-                    elem_repr = element_repr(elem.Index, Qt.red, width)
-                elif isinstance(elem, at.elements.Sextupole):
-                    elem_repr = element_repr(elem.Index, Qt.yellow, width)
-                elif isinstance(elem, at.elements.Corrector):
-                    elem_repr = element_repr(elem.Index, Qt.blue, width)
-                else:
-                    elem_repr = element_repr(elem.Index, Qt.gray, width)
-                lat_repr.append(elem_repr)
-        return lat_repr
-
-    def calc_new_width(self, new_width):
-        """Calculate the new widths of the element representations so that
-        they may be dynamically scaled to fit into the new window size, whilst
-        remaining roughly proportional to their lengths.
-        """
-        scale_factor = new_width / sum(self.base_widths)
-        scaled_widths = [width * scale_factor for width in self.base_widths]
-        rounding = []
-        for index in range(len(scaled_widths)):
-            if scaled_widths[index] == 0:
-                pass
-            elif scaled_widths[index] < 1:
-                scaled_widths[index] = 1
-            else:
-                value = scaled_widths[index]
-                scaled_widths[index] = round(value)
-                if round(value) >= 2:
-                    rounding.append((value, index))
-        rounding.sort()  # sort smallest to biggest
-        diff = round(sum(scaled_widths) - new_width)
-        if abs(diff) > len(rounding):
-            raise ValueError("too many elements with 0<length<1")
-        if diff > 0:  # overshoot
-            for i in range(diff):
-                _, index = rounding.pop()
-                scaled_widths[index] = numpy.maximum(scaled_widths[index]-1, 1)
-        elif diff < 0:  # undershoot
-            for i in range(abs(diff)):
-                _, index = rounding.pop(0)
-                scaled_widths[index] = scaled_widths[index]+1
-        return scaled_widths
-
-    def calc_zero_len_repr(self, width):
-        """Create element representations for elements in the lattice with 0
-        length, to be displayed below the non-zero length element
-        representations.
-        See also: create_lat_repr
-        """
-        scale_factor = width / self.total_len
-        all_s = self._atsim.get_s()
-        positions = [0.0]
-        for elem in self.zero_length:
-            positions.append(all_s[elem.Index-1] * scale_factor)
-        zero_len_repr = []
-        for i in range(1, len(positions), 1):
-            gap_length = int(round(positions[i] - positions[i-1]))
-            # N.B. zero length gap spacers are not drag-and-drop-able as they
-            # are not drifts, however this could potentially be added in future
-            # to allow zero length elements to be moved.
-            zero_len_repr.append(element_repr(-1, Qt.white, gap_length,
-                                              drag=False))
-            elem = self.zero_length[i-1]
-            if isinstance(elem, at.elements.Monitor):
-                elem_repr = element_repr(elem.Index, Qt.magenta, 1)
-            elif isinstance(elem, at.elements.RFCavity):
-                elem_repr = element_repr(elem.Index, Qt.cyan, 1)
-            elif isinstance(elem, at.elements.Corrector):
-                elem_repr = element_repr(elem.Index, Qt.blue, 1)
-            else:
-                elem_repr = element_repr(elem.Index, Qt.gray, 1)
-            zero_len_repr.append(elem_repr)
-        diff = int(sum([el_repr.width for el_repr in zero_len_repr]) - width)
-        if diff < 0:  # undershoot
-            # unless the last zero length element is very close to the end of
-            # the displayed section this should always occur.
-            zero_len_repr.append(element_repr(-1, Qt.white, abs(diff),
-                                              drag=False))
-        elif diff > 0:  # overshoot
-            # this should rarely occur
-            # add zero len elem_repr at the end to maintain consistent length
-            zero_len_repr.append(element_repr(-1, Qt.white, 0, drag=False))
-            while diff > 1:
-                for i in range(len(zero_len_repr)):
-                    el_repr = zero_len_repr[i]
-                    if el_repr.width > 1:
-                        el_repr.changeSize(el_repr.width - 1)
-                        diff -= 1
-                    if diff < 1:
-                        break
+    def init_calc_thread(self):
+        """Start the background thread that recalculates the linear optics
+        after edits. Edits made within calc_delay milliseconds of each other
+        are coalesced into one calculation, and each edit increments the
+        generation so that the results of calculations started before the
+        latest edit are discarded rather than displayed. The worker is given
+        its own copy of the lattice, once, and then only sent the edits.
+        """
+        self.generation = 0
+        self.calculating = False
+        self.edits = []  # (index, field, cell, value) not yet sent
+        self.calc_delay = 50
+        self.calc_timer = QTimer(self)
+        self.calc_timer.setSingleShot(True)
+        self.calc_timer.timeout.connect(self.start_calculation)
+        self.calc_thread = QThread(self)
+        self.calc_worker = CalcWorker(copy.deepcopy(self.lattice))
+        self.calc_worker.moveToThread(self.calc_thread)
+        self.calculate.connect(self.calc_worker.calculate)
+        self.calc_worker.finished.connect(self.calculation_finished)
+        self.calc_thread.start()
+
+    def edit_element(self, index, field, cell, value):
+        """Change a field, or the cell of an array field if cell isn't None,
+        of the element at index, and request a recalculation.
+        """
+        set_parameter(self.lattice, index, field, cell, value)
+        self.edits.append((index, field, cell, value))
+        self.request_calculation()
+
+    def request_calculation(self):
+        """Called after every edit to the lattice; mark the displayed data
+        as out of date and (re)start the coalescing timer.
+        """
+        self.generation += 1
+        self.set_calculating(True)
+        self.calc_timer.start(self.calc_delay)
+
+    def start_calculation(self):
+        """Ask the worker to recalculate, unless it is already busy, in which
+        case calculation_finished will start again once it is done. The
+        edits made since the last calculation are handed over to the worker,
+        which applies them to its own lattice, so edits made while it
+        calculates don't change the lattice under it.
+        """
+        if not self.calculating:
+            self.calculating = True
+            edits, self.edits = self.edits, []
+            self.calculate.emit(self.generation, edits)
+
+    def calculation_finished(self, generation, result):
+        """Display the results of a finished calculation, if no edits have
+        been made since it started, otherwise discard them and recalculate.
+        """
+        self.calculating = False
+        if generation != self.generation:
+            if not self.calc_timer.isActive():
+                self.start_calculation()
+            return
+        if isinstance(result, Exception):
+            self.set_calculating(False)
+            self.statusBar().showMessage("Calculation failed: {0}"
+                                         .format(result))
+            return
+        self.optics_data, self.lattice_data = result
+        self.refresh_all()
+        self.set_calculating(False)
+
+    def set_calculating(self, calculating):
+        """Show, or clear, the calculating state; while calculating, the
+        displayed optics data is out of date, so it is greyed out.
+        """
+        if calculating:
+            self.statusBar().showMessage("Calculating...")
         else:
-            # add zero len elem_repr at the end to maintain consistent length
-            zero_len_repr.append(element_repr(-1, Qt.white, 0, drag=False))
-        return zero_len_repr
+            self.statusBar().showMessage("Ready")
+        style = "color:gray;" if calculating else ""
+        for lab in list(self.lattice_data_widgets.values()) + list(
+                self.element_data_widgets.values()):
+            lab.setStyleSheet(style)
 
-    def get_lattice_data(self):
-        """Calculate the global linear optics data for the lattice, and return
-        it in a dictionary by its field names.
+    def closeEvent(self, event):
+        """Stop the calculation thread before closing.
         """
-        self._atsim.wait_for_calculations()
-        data_dict = OrderedDict()
-        data_dict["Number of Elements"] = len(self.lattice)
-        data_dict["Total Length"] = self.total_len
-        data_dict["Total Bend Angle"] = self._atsim.get_total_bend_angle()
-        data_dict["Total Absolute Bend Angle"] = self._atsim.get_total_absolute_bend_angle()
-        data_dict["Cell Tune"] = [self._atsim.get_tune('x'),
-                                  self._atsim.get_tune('y')]
-        data_dict["Linear Chromaticity"] = [self._atsim.get_chromaticity('x'),
-                                            self._atsim.get_chromaticity('y')]
-        data_dict["Horizontal Emittance"] = self._atsim.get_horizontal_emittance() * 1e12
-        data_dict["Linear Dispersion Action"] = self._atsim.get_linear_dispersion_action()
-        data_dict["Momentum Spread"] = self._atsim.get_energy_spread()
-        data_dict["Linear Momentum Compaction"] = self._atsim.get_momentum_compaction()
-        data_dict["Energy Loss per Turn"] = self._atsim.get_energy_loss()
-        data_dict["Damping Times"] = self._atsim.get_damping_times() * 1e3
-        data_dict["Damping Partition Numbers"] = self._atsim.get_damping_partition_numbers()
-        return data_dict
+        self.calc_thread.quit()
+        self.calc_thread.wait()
+        super().closeEvent(event)
 
     def get_element_data(self, selected_s_pos):
         """Calculate the local (for the element at the selected s position)
         linear optics data for the lattice, and return it in a dictionary by
         its field names.
         """
-        self._atsim.wait_for_calculations()
+        data = self.optics_data
         data_dict = OrderedDict()
-        all_s = self._atsim.get_s()
-        index = int(numpy.where([s <= selected_s_pos for s in all_s])[0][-1])
+        all_s = data['s_pos']
+        index = int(self.element_at(selected_s_pos))
         data_dict["Selected S Position"] = selected_s_pos
         data_dict["Element Index"] = index + 1
         data_dict["Element Start S Position"] = all_s[index]
-        data_dict["Element Length"] = self._atsim.get_at_element(index+1).Length
-        data_dict["Horizontal Linear Dispersion"] = self._atsim.get_dispersion()[index, 0]
-        data_dict["Beta Function"] = self._atsim.get_beta()[index]
-        data_dict["Derivative of Beta Function"] = self._atsim.get_alpha()[index]
-        data_dict["Normalized Phase Advance"] = self._atsim.get_mu()[index]/(2*numpy.pi)
+        data_dict["Element Length"] = self.lattice[index].Length
+        data_dict["Horizontal Linear Dispersion"] = data['dispersion'][index, 0]
+        data_dict["Beta Function"] = data['beta'][index]
+        data_dict["Derivative of Beta Function"] = data['alpha'][index]
+        data_dict["Normalized Phase Advance"] = data['mu'][index]/(2*numpy.pi)
         return data_dict
 
+    def element_at(self, s_pos):
+        """Return the index of the element at an s position (or positions),
+        the last element starting at or before it, by binary search of the
+        sorted element start positions.
+        """
+        index = numpy.searchsorted(self.optics_data['s_pos'][:-1], s_pos,
+                                   side='right') - 1
+        return numpy.clip(index, 0, len(self.lattice) - 1)
+
+    def local_optics(self, s_pos):
+        """Return the index of the element at an s position and the beta
+        functions, alpha functions, horizontal dispersion and phase advances
+        there, interpolated within the element. Beta and dispersion are
+        cubic Hermite interpolated using their derivatives at each end of the
+        element, which is exact in drifts, alpha and mu linearly.
+        """
+        data = self.optics_data
+        index = self.element_at(s_pos)
+        s0, s1 = data['s_pos'][index], data['s_pos'][index + 1]
+        length = numpy.asarray(s1 - s0, dtype=float)
+        t = numpy.divide(s_pos - s0, length, out=numpy.zeros(length.shape),
+                         where=length > 0)
+        h00 = 2 * t**3 - 3 * t**2 + 1
+        h10 = (t**3 - 2 * t**2 + t) * length
+        h01 = -2 * t**3 + 3 * t**2
+        h11 = (t**3 - t**2) * length
+        beta0, beta1 = data['beta'][index], data['beta'][index + 1]
+        alpha0, alpha1 = data['alpha'][index], data['alpha'][index + 1]
+        eta0, eta1 = data['dispersion'][index], data['dispersion'][index + 1]
+        mu0, mu1 = data['mu'][index], data['mu'][index + 1]
+        # For arrays of s positions the planes are the last axis
+        plane = (Ellipsis, numpy.newaxis)
+        return {
+            'index': index,
+            'beta': (h00[plane] * beta0 - 2 * h10[plane] * alpha0 +
+                     h01[plane] * beta1 - 2 * h11[plane] * alpha1),
+            'alpha': alpha0 + t[plane] * (alpha1 - alpha0),
+            'dispersion': (h00 * eta0[..., 0] + h10 * eta0[..., 1] +
+                           h01 * eta1[..., 0] + h11 * eta1[..., 1]),
+            'mu': mu0 + t[plane] * (mu1 - mu0)
+        }
+
     def stringify(self, value):
         """Convert numerical data into a string that can be displayed.
         """
@@ -402,7 +379,7 @@ class Window(QMainWindow):
         """Iterate over the global linear optics data and update the values of
         each field. Usually called after a change has been made to the lattice.
         """
-        for field, value in self.get_lattice_data().items():
+        for field, value in self.lattice_data.items():
             self.lattice_data_widgets[field].setText(self.stringify(value))
 
     def update_element_data(self, s_pos):
@@ -412,35 +389,212 @@ class Window(QMainWindow):
         for field, value in self.get_element_data(s_pos).items():
             self.element_data_widgets[field].setText(self.stringify(value))
 
-    def plot(self):
-        """Plot the graph inside the figure.
+    def create_plot(self):
+        """Create the axes and lines of the graph once; plot then only
+        changes the lines' data, and the s selection line is animated so that
+        it can be moved by blitting rather than redrawing the whole figure.
         """
-        self.figure.clear()
         self.axl = self.figure.add_subplot(111, xmargin=0, ymargin=0.025)
         self.axl.set_xlabel('s position [m]')
         self.axr = self.axl.twinx()
         self.axr.margins(0, 0.025)
-        self.lattice.radiation_off()  # ensure radiation state for linopt call
-        at.plot.plot_beta(self.lattice, axes=(self.axl, self.axr))
-        self.canvas.draw()
+        self.beta_lines = (self.axl.plot([], [], 'b', label=r'$\beta_x$') +
+                           self.axl.plot([], [], 'r', label=r'$\beta_y$'))
+        self.disp_line, = self.axr.plot([], [], 'g', label=r'$\eta_x$')
+        # Filled min to max envelopes replace the lines when zoomed out far
+        # enough that there are more elements than pixels, as they are much
+        # faster to draw than lines zigzagging between the extremes
+        self.envelopes = [
+            ax.fill_between([], [], [], color=line.get_color(), alpha=0.5,
+                            linewidth=0, visible=False)
+            for ax, line in zip([self.axl, self.axl, self.axr],
+                                self.beta_lines + [self.disp_line])
+        ]
+        self.axl.set_ylabel(r'$\beta$ [m]')
+        self.axr.set_ylabel('dispersion [m]')
+        # On the twin axes, which are drawn over the beta functions' axes
+        self.axr.legend(handles=self.beta_lines + [self.disp_line],
+                        loc='upper left')
+        self.s_line = self.axl.axvline(0, color="black", linestyle='--',
+                                       zorder=3, visible=False, animated=True)
+        # Follows the mouse, blitted like the s selection line
+        self.hover_line = self.axl.axvline(0, color="gray", linestyle=':',
+                                           zorder=3, visible=False,
+                                           animated=True)
+        self.overlays = [self.s_line, self.hover_line]
+        self.background = None
+        self.plot()
+
+    def update_layout(self, event=None):
+        """Fit the axes to the figure, on resizing and after calculations;
+        this isn't done on every draw, as it would take longer than the rest
+        of a draw while zooming and panning.
+        """
+        self.figure.tight_layout(pad=0.5, w_pad=0, h_pad=0)
+
+    def plot(self):
+        """Update the beta functions and horizontal dispersion on the graph
+        from the latest optics, for the section of the lattice in view,
+        rescale the axes, and schedule a redraw.
+        The detail plotted depends on how many elements are in view, so
+        that about as many points are plotted as there are pixels: the
+        optics interpolated within the elements when zoomed in, the optics
+        at the start of each element, or, when there are more elements than
+        pixels, the envelope of the minimum and maximum of each pixel's
+        elements.
+        """
+        data = self.optics_data
+        s_min, s_max = self.view
+        s_pos = data['s_pos']
+        # The elements in view, and the positions either side of them
+        first = int(self.element_at(s_min))
+        last = min(numpy.searchsorted(s_pos, s_max) + 1, len(s_pos))
+        n_pixels = max(int(self.axl.bbox.width), 100)
+        if last - first <= n_pixels // 4:
+            s = numpy.union1d(numpy.linspace(s_min, s_max, n_pixels),
+                              s_pos[first:last])
+            optics = self.local_optics(s)
+            values = [optics['beta'][:, 0], optics['beta'][:, 1],
+                      optics['dispersion']]
+        else:
+            s = s_pos[first:last]
+            values = [data['beta'][first:last, 0],
+                      data['beta'][first:last, 1],
+                      data['dispersion'][first:last, 0]]
+        decimated = last - first > 2 * n_pixels
+        if decimated:
+            s, values = min_max_decimate(s, values, s_min, s_max, n_pixels)
+        for line, envelope, y in zip(self.beta_lines + [self.disp_line],
+                                     self.envelopes, values):
+            line.set_data(s, y)  # hidden lines still set the axes' limits
+            line.set_visible(not decimated)
+            envelope.set_visible(decimated)
+            if decimated:
+                envelope.set_verts([numpy.column_stack([
+                    numpy.concatenate([s[::2], s[::-2]]),
+                    numpy.concatenate([y[1::2], y[-2::-2]])
+                ])])
+        self.axl.set_xlim(s_min, s_max)
+        for ax in (self.axl, self.axr):
+            ax.relim()
+            ax.autoscale_view(scalex=False)
+        self.canvas.draw_idle()
+
+    def set_view(self, s_min, s_max):
+        """Show the section of the lattice from s_min to s_max on the graph
+        and the lattice representation, limited to the lattice and to spans
+        of at least min_span.
+        """
+        span = min(max(s_max - s_min, self.min_span), self.total_len)
+        s_min = min(max(s_min, 0.0), self.total_len - span)
+        self.view = (s_min, s_min + span)
+        self.strip.set_view(*self.view)
+        self.plot()
+
+    def scroll_view(self, s_pos, steps, pan=False):
+        """Zoom in, for positive steps, or out by zoom_factor per step,
+        keeping s_pos where it is, or if pan is True move the view by a tenth
+        of its span per step.
+        """
+        s_min, s_max = self.view
+        if pan:
+            shift = -0.1 * steps * (s_max - s_min)
+            self.set_view(s_min + shift, s_max + shift)
+        else:
+            factor = self.zoom_factor ** -steps
+            self.set_view(s_pos - (s_pos - s_min) * factor,
+                          s_pos + (s_max - s_pos) * factor)
+
+    def cache_background(self, event):
+        """Called after every full draw of the graph; keep the rendered
+        figure, without the animated overlays, to blit over.
+        """
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        for artist in self.overlays:
+            self.figure.draw_artist(artist)
+
+    def blit_overlays(self):
+        """Redraw only the s selection and hover lines over the cached
+        background.
+        """
+        if self.background is None:  # not drawn yet, draw_event will do it
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        for artist in self.overlays:
+            self.figure.draw_artist(artist)
+        self.canvas.blit(self.figure.bbox)
+
+    def graph_onhover(self, event):
+        """Show the local optics at the mouse's s position, interpolated
+        within the element under it, in the hover readout, and a dotted line
+        there. The readout is a label rather than text on the graph, as
+        rendering text in the figure is too slow to follow the mouse.
+        While the middle button is held the view is panned instead.
+        """
+        if self.pan_start is not None:
+            x, (s_min, s_max) = self.pan_start
+            shift = (x - event.x) * (s_max - s_min) / self.axl.bbox.width
+            self.set_view(s_min + shift, s_max + shift)
+            return
+        if event.xdata is None:
+            self.graph_onleave(event)
+            return
+        s_pos = min(max(event.xdata, 0.0), self.total_len)
+        optics = self.local_optics(s_pos)
+        elem = self.lattice[int(optics['index'])]
+        self.hover_line.set_xdata([s_pos, s_pos])
+        self.hover_line.set_visible(True)
+        self.hover_label.setText(
+            "s: {0:.3f} m  [{1}] {2}  beta: {3[0]:.4f}, {3[1]:.4f} m  "
+            "alpha: {4[0]:.4f}, {4[1]:.4f}  eta_x: {5:.5f} m  "
+            "mu/2pi: {6[0]:.5f}, {6[1]:.5f}"
+            .format(s_pos, int(optics['index']) + 1, elem.FamName,
+                    optics['beta'], optics['alpha'], optics['dispersion'],
+                    optics['mu'] / (2 * numpy.pi))
+        )
+        self.blit_overlays()
+
+    def graph_onscroll(self, event):
+        """Scroll to zoom about the mouse, or with shift held to pan.
+        """
+        if event.xdata is not None:
+            self.scroll_view(event.xdata, event.step, event.key == 'shift')
+
+    def graph_onrelease(self, event):
+        """Stop panning when the middle button is released.
+        """
+        if event.button == 2:
+            self.pan_start = None
+
+    def graph_onleave(self, event):
+        """Hide the hover readout when the mouse leaves the graph.
+        """
+        if self.hover_line.get_visible():
+            self.hover_line.set_visible(False)
+            self.hover_label.setText("")
+            self.blit_overlays()
 
     def graph_onclick(self, event):
         """Left click to make an s position selection and display a black
         dashed line at that position on the graph.
+        Middle click and drag to pan.
         Right click to clear a selection.
         """
-        if event.xdata is not None:
-            if self.s_selection is not None:
-                self.s_selection.remove()  # remove old s selection line
+        if event.button == 2:
+            self.pan_start = (event.x, self.view)
+        elif event.xdata is not None:
             if event.button == 1:
-                self.s_selection = self.axl.axvline(event.xdata, color="black",
-                                                    linestyle='--', zorder=3)
+                self.s_selection = event.xdata
+                self.s_line.set_xdata([event.xdata, event.xdata])
+                self.s_line.set_visible(True)
                 self.update_element_data(event.xdata)
             else:  # if not right click clear selection data
                 self.s_selection = None
+                self.s_line.set_visible(False)
                 for lab in self.element_data_widgets.values():
                     lab.setText("N/A")
-            self.canvas.draw()
+            self.blit_overlays()
 
     def resize_graph(self, width, height, redraw=False):
         """Resize the graph to a new width and(or) height; can also be used to
@@ -460,18 +614,15 @@ class Window(QMainWindow):
 
     def refresh_all(self):
         """Refresh the graph, global linear optics data, and local linear
-        optics data.
+        optics data from the latest calculation.
         """
-        self.plot()
-        self.resizeEvent(None)
+        self.total_len = self.optics_data['s_pos'][-1]
+        self.strip.set_positions(self.optics_data['s_pos'])
+        self.set_view(*self.view)  # also replots, within the new length
+        self.update_layout()
         self.update_lattice_data()
-        s_pos = self.element_data_widgets["Selected S Position"].text()
-        if s_pos != "N/A":
-            self.update_element_data(float(s_pos))
-            self.s_selection.remove()
-            self.s_selection = self.axl.axvline(float(s_pos), color="black",
-                                                linestyle='--', zorder=3)
-            self.canvas.draw()
+        if self.s_selection is not None:
+            self.update_element_data(self.s_selection)
         for box in self.edit_boxes:
             box.refresh()
 
@@ -490,81 +641,311 @@ class Window(QMainWindow):
         height = int(max([self.frameGeometry().height() - 350, 480]))
         # Resize graph
         self.resize_graph(width, height)
-        # Get non-zero length element representation widths from graph width
-        widths = self.calc_new_width(width - 127)
-        for el_repr, w in zip(self.lat_repr, widths):
-            if w != el_repr.width:
-                el_repr.changeSize(w)
-        # Two px more to account for end bars
-        self.mid_line.changeSize(width - 125)
-        # Get lattice representation width from graph width
-        zlr = self.calc_zero_len_repr(width - 127)
-        zl_widths = [el_repr.width for el_repr in zlr]
-        for el_repr, w in zip(self.zl_repr, zl_widths):
-            el_repr.changeSize(w)
+        # Get lattice representation width from graph width, two px more
+        # than the elements to account for end bars
+        self.strip.setFixedWidth(width - 125)
         # If not a refresh call then resize the window
         if event is not None:
             super().resizeEvent(event)
 
 
-class element_repr(QWidget):
-    """Class for creating the coloured element representation bars/boxes.
+class CalcWorker(QObject):
+    """Recalculates the linear optics in a background thread, so that the
+    window stays responsive while they are calculated. It keeps its own
+    copy of the lattice, to which it applies the edits it is sent, and sends
+    the results back through finished, so nothing is shared between the
+    threads. The optics are calculated by an IncrementalOptics engine on
+    its lattice, which only recalculates the edited elements, and linopt is
+    only used for the chromaticity, or for everything if the lattice has
+    kicks or offsets, which the engine doesn't allow for.
     """
-    def __init__(self, index, colour, width, height=50, drag=True):
-        # Default height is 50px making the total height, including the
-        # dividing line, of the lattice representation 101px.
-        # Other values don't work.
+    # The generation of the calculation and its result, either the optics
+    # data and lattice data, or the exception raised calculating them.
+    finished = pyqtSignal(int, object)
+
+    def __init__(self, lattice):
         super().__init__()
-        self.index = index
-        self.colour = colour
-        self.width = width
-        self.height = height
-        self.draggable = drag
-        self.setMinimumHeight(height)
-        self.setMinimumWidth(width)
+        self.lattice = lattice
+        self.optics = None  # built in the worker's thread when first needed
+        self.orbit_sources = None
+
+    def calculate(self, generation, edits):
+        """Called, in the worker's thread, through Window.calculate, with the
+        edits, (index, field, cell, value), made since the last call.
+        """
+        try:
+            for index, field, cell, value in edits:
+                set_parameter(self.lattice, index, field, cell, value)
+            if self.optics is None:
+                self.optics = IncrementalOptics(self.lattice)
+            else:
+                self.optics.invalidate([edit[0] for edit in edits])
+            if (self.orbit_sources is None) or any(
+                    [edit[1] in ['KickAngle', 'T1', 'T2'] for edit in edits]):
+                self.orbit_sources = has_orbit_sources(self.lattice)
+            if self.orbit_sources:
+                result = calc_optics(self.lattice)
+            else:
+                refpts = range(len(self.lattice) + 1)
+                _, tune, _, lindata = self.optics.linopt(refpts)
+                chrom = at.linopt(self.lattice, get_chrom=True,
+                                  coupled=False)[2]
+                result = calc_optics(self.lattice, (tune, chrom, lindata))
+        except Exception as error:
+            result = error
+        self.finished.emit(generation, result)
+
+
+def set_parameter(lattice, index, field, cell, value):
+    """Set a field of the element at index to value, or the cell of an array
+    field if cell isn't None.
+    """
+    if cell is None:
+        setattr(lattice[index], field, value)
+    else:
+        getattr(lattice[index], field)[cell] = value
+
+
+def calc_optics(lattice, initial=None):
+    """Calculate the linear optics of the lattice and return the optics data,
+    a dictionary of the s positions, beta and alpha functions, dispersion
+    and phase advances at the start of every element and the end of the
+    lattice, and the global lattice data, in a dictionary by its field
+    names. The global data beyond the tunes and chromaticities is found from
+    the radiation integrals, see radiation.py. If given, initial is the
+    lattice's (tune, chrom, lindata), e.g. as cached by lattice_cache.load,
+    and is used rather than calling linopt.
+    """
+    if initial is None:
+        refpts = range(len(lattice) + 1)
+        _, tune, chrom, lindata = at.linopt(lattice, refpts=refpts,
+                                            get_chrom=True, coupled=False)
+    else:
+        tune, chrom, lindata = initial
+    optics_data = {field: numpy.array(lindata[field]) for field in
+                   ['s_pos', 'beta', 'alpha', 'dispersion', 'mu']}
+    dipoles = radiation.dipole_indices(lattice)
+    integrals = radiation.radiation_integrals(lattice, dipoles,
+                                              lindata[dipoles])
+    length = optics_data['s_pos'][-1]
+    params = radiation.radiation_parameters(integrals, lattice.energy, length)
+    angles = numpy.array([lattice[i].BendingAngle for i in dipoles])
+    data_dict = OrderedDict()
+    data_dict["Number of Elements"] = len(lattice)
+    data_dict["Total Length"] = length
+    data_dict["Total Bend Angle"] = numpy.degrees(numpy.sum(angles))
+    data_dict["Total Absolute Bend Angle"] = numpy.degrees(
+        numpy.sum(numpy.abs(angles)))
+    data_dict["Cell Tune"] = numpy.mod(tune, 1)
+    data_dict["Linear Chromaticity"] = chrom
+    data_dict["Horizontal Emittance"] = params['emittance'] * 1e12
+    data_dict["Linear Dispersion Action"] = integrals[4] / integrals[1]
+    data_dict["Momentum Spread"] = params['energy_spread']
+    data_dict["Linear Momentum Compaction"] = params['momentum_compaction']
+    data_dict["Energy Loss per Turn"] = params['energy_loss']
+    data_dict["Damping Times"] = params['damping_times'] * 1e3
+    data_dict["Damping Partition Numbers"] = numpy.array(
+        [params['partition_x'], 1.0, params['partition_e']])
+    return optics_data, data_dict
+
+
+class lattice_strip(QWidget):
+    """A single widget painting the whole lattice representation: bars for
+    the non-zero length elements, proportional to their lengths, above a
+    dividing line, and ticks below it for the zero length elements at their
+    s positions, all colour coded by type. The elements' extents are kept in
+    arrays, so their pixel positions are calculated in one pass on each
+    paint and the element under the mouse is found by binary search when it
+    is dragged to an edit box. Only the elements in view, the section of
+    the lattice shown, are drawn, and bars hidden under the next bar are
+    skipped, so at most about one bar is drawn per pixel however many
+    elements are in view.
+    """
+    # The s position under the mouse, the wheel steps, and whether to pan
+    scrolled = pyqtSignal(float, float, bool)
+    bar_height = 50  # each half, plus the 1px dividing line between them
+    colours = [Qt.white, Qt.green, Qt.red, Qt.yellow, Qt.blue, Qt.gray,
+               Qt.magenta, Qt.cyan]
+
+    def __init__(self, lattice):
+        super().__init__()
+        self.indices = numpy.array([elem.Index for elem in lattice])
+        # Colour codes, into colours, for each element as a bar and a tick
+        self.bar_colours = numpy.array([self.bar_colour(elem)
+                                        for elem in lattice])
+        self.tick_colours = numpy.array([self.tick_colour(elem)
+                                         for elem in lattice])
+        # Zero length drifts, markers and apertures aren't shown
+        self.hidden = numpy.array([
+            isinstance(elem, (at.elements.Drift, at.elements.Marker,
+                              at.elements.Aperture)) for elem in lattice
+        ])
+        self.press_index = None
+        self.view = None
+        self.setFixedHeight(2 * self.bar_height + 1)
+
+    @staticmethod
+    def bar_colour(elem):
+        if isinstance(elem, at.elements.Drift):
+            return 0
+        elif isinstance(elem, at.elements.Dipole):
+            return 1
+        elif isinstance(elem, at.elements.Quadrupole):
+            return 2
+        elif isinstance(elem, at.elements.Sextupole):
+            return 3
+        elif isinstance(elem, at.elements.Corrector):
+            return 4
+        return 5
+
+    @staticmethod
+    def tick_colour(elem):
+        if isinstance(elem, at.elements.Monitor):
+            return 6
+        elif isinstance(elem, at.elements.RFCavity):
+            return 7
+        elif isinstance(elem, at.elements.Corrector):
+            return 4
+        return 5
+
+    def set_positions(self, s_pos):
+        """Set the s positions of the elements' starts, and the end of the
+        lattice, e.g. after their lengths are changed, and repaint.
+        """
+        s_pos = numpy.asarray(s_pos, dtype=float)
+        self.starts = s_pos[:-1]
+        self.ends = s_pos[1:]
+        self.total_len = s_pos[-1]
+        lengths = numpy.diff(s_pos)
+        self.bars = numpy.flatnonzero(lengths > 0)
+        self.ticks = numpy.flatnonzero((lengths == 0) & ~self.hidden)
+        self.update()
+
+    def set_view(self, s_min, s_max):
+        """Show the section of the lattice from s_min to s_max, and repaint.
+        """
+        self.view = (s_min, s_max)
+        self.update()
+
+    def pixel_positions(self):
+        """Return the bars in view, their left and right pixel edges, the
+        ticks in view, and their pixel positions, for the current width and
+        view, inside the 1px end bars. Edges are rounded from the s
+        positions, so the bars stay proportional to their lengths and always
+        fill the width exactly, but every bar is at least 1px wide.
+        """
+        s_min, s_max = self.view or (0.0, self.total_len)
+        scale = (self.width() - 2) / (s_max - s_min)
+        starts, ends = self.starts[self.bars], self.ends[self.bars]
+        lo = numpy.searchsorted(ends, s_min, side='right')
+        hi = numpy.searchsorted(starts, s_max)
+        bars = self.bars[lo:hi]
+        left = 1 + numpy.round((numpy.maximum(starts[lo:hi], s_min) - s_min) *
+                               scale).astype(int)
+        right = 1 + numpy.round((numpy.minimum(ends[lo:hi], s_max) - s_min) *
+                                scale).astype(int)
+        right = numpy.maximum(right, left + 1)
+        tick_s = self.starts[self.ticks]
+        lo = numpy.searchsorted(tick_s, s_min)
+        hi = numpy.searchsorted(tick_s, s_max, side='right')
+        tick_x = 1 + numpy.round((tick_s[lo:hi] - s_min) *
+                                 scale).astype(int)
+        return (bars, left, right, self.ticks[lo:hi],
+                numpy.minimum(tick_x, self.width() - 2))
 
     def paintEvent(self, event):
-        """Called on creation and resize(repaint).
+        """Called on creation, resize and update; draws the rectangles of
+        each colour together.
         """
         qp = QPainter(self)
-        qp.setPen(self.colour)
-        qp.setBrush(self.colour)
-        qp.drawRect(0, 0, self.width, self.height)
-
-    def changeSize(self, width, height=None):
-        """Called on resize; minimum width and height are set to prevent
-        stretching/squishing.
-        """
-        # Allowing height changing here is a recipe for disaster...
-        self.width = width
-        self.setMinimumWidth(width)
-        if height is not None:
-            self.height = height
-            self.setMinimumHeight(height)
-        self.repaint()
+        width, height = self.width(), self.bar_height
+        qp.fillRect(0, 0, width, 2 * height + 1, Qt.white)
+        bars, left, right, ticks, tick_x = self.pixel_positions()
+        # Skip bars that the next bar covers, as many do when there are more
+        # elements than pixels, so at most about one bar is drawn per pixel
+        covered = numpy.append((left[1:] == left[:-1]) &
+                               (right[1:] >= right[:-1]), False)
+        bar_colours = numpy.where(covered, -1, self.bar_colours[bars])
+        tick_colours = self.tick_colours[ticks]
+        qp.setPen(Qt.NoPen)
+        for code, colour in enumerate(self.colours):
+            if code == 0:
+                continue  # drifts are white, like the background
+            shown = bar_colours == code
+            rects = [QRect(int(x0), 0, int(x1 - x0), height)
+                     for x0, x1 in zip(left[shown], right[shown])]
+            rects += [QRect(int(x), height + 1, 1, height) for x in
+                      numpy.unique(tick_x[tick_colours == code])]
+            if rects:
+                qp.setBrush(colour)
+                qp.drawRects(rects)
+        # End bars and dividing line
+        qp.fillRect(0, 0, 1, 2 * height + 1, Qt.black)
+        qp.fillRect(width - 1, 0, 1, 2 * height + 1, Qt.black)
+        qp.fillRect(0, height, width, 1, Qt.black)
+
+    def element_at(self, x, y):
+        """Return the index (from 1) of the element drawn at pixel (x, y),
+        or None; ticks are 1px wide, so they are found within 2px.
+        """
+        bars, left, right, ticks, tick_x = self.pixel_positions()
+        if y < self.bar_height:
+            n = numpy.searchsorted(left, x, side='right') - 1
+            if n >= 0 and x < right[n]:
+                return int(self.indices[bars[n]])
+        elif y > self.bar_height:
+            n = numpy.searchsorted(tick_x, x - 2)
+            if n < len(tick_x) and tick_x[n] <= x + 2:
+                return int(self.indices[ticks[n]])
+        return None
+
+    def wheelEvent(self, event):
+        """Scroll to zoom about the mouse, or with shift held to pan, like
+        the graph.
+        """
+        s_min, s_max = self.view or (0.0, self.total_len)
+        s_pos = s_min + (event.x() - 1) * (s_max - s_min) / (self.width() - 2)
+        self.scrolled.emit(s_pos, event.angleDelta().y() / 120,
+                           bool(event.modifiers() & Qt.ShiftModifier))
+
+    def mousePressEvent(self, event):
+        self.press_index = self.element_at(event.x(), event.y())
 
     def mouseMoveEvent(self, event):
         """Allows drag and drop functionality, on left click and hold.
         """
-        if self.draggable:
-            if event.buttons() == Qt.LeftButton:
-                mimeData = QMimeData()
-                mimeData.setText(str(self.index))
-                drag = QDrag(self)
-                drag.setMimeData(mimeData)
-                drag.exec(Qt.MoveAction)
-        return
+        if (self.press_index is not None) and (event.buttons() ==
+                                               Qt.LeftButton):
+            mimeData = QMimeData()
+            mimeData.setText(str(self.press_index))
+            self.press_index = None  # one drag per press
+            drag = QDrag(self)
+            drag.setMimeData(mimeData)
+            drag.exec(Qt.MoveAction)
+
+
+def min_max_decimate(x, ys, x_min, x_max, n_bins):
+    """Reduce x, and each array in the list ys, to the minimum and maximum
+    of the ys in each of n_bins equal bins of x between x_min and x_max,
+    both at the first x of the bin, so that a line through them covers the
+    same range as the full data with at most 2 * n_bins points.
+    """
+    bins = numpy.floor((x - x_min) * (n_bins / (x_max - x_min))).astype(int)
+    starts = numpy.flatnonzero(numpy.diff(bins, prepend=bins[0] - 1))
+    ys = [numpy.column_stack([numpy.minimum.reduceat(y, starts),
+                              numpy.maximum.reduceat(y, starts)]).ravel()
+          for y in ys]
+    return numpy.repeat(x[starts], 2), ys
 
 
 class edit_box(QGroupBox):
     """Class for creating element editing boxes that element representations
     can be dragged to to display information and be edited.
     """
-    def __init__(self, window, atsim):
+    def __init__(self, window):
         super().__init__()
         self.parent_window = window
-        self.lattice = atip.utils.get_sim_lattice(atsim)
-        self._atsim = atsim
+        self.lattice = window.lattice
         self.setMaximumSize(350, 200)
         self.setAcceptDrops(True)
         self.dl = self.create_box()
@@ -671,75 +1052,30 @@ class edit_box(QGroupBox):
 
     def enterPress(self):
         """On an enter press in an editable field, do some data processing and
-        then apply the change to the base lattice, then trigger a recalculation
-        of the linear optics data, then refresh the window to display the newly
-        calculated data.
+        then apply the change to the window's lattice, which requests a
+        background recalculation of the linear optics data; the window is
+        refreshed to display the newly calculated data once it finishes.
         """
-        change = True
-        element = self.lattice[int(self.dl["Index"].text()) - 1]
+        index = int(self.dl["Index"].text()) - 1
+        element = self.lattice[index]
+        set_point = self.dl["SetPoint"][0].currentText()
+        edit = None  # (field, cell, value)
         if round(element.Length, 5) != float(self.dl["Length"].text()):
-            length = float(self.dl["Length"].text())
-            element.Length = length
+            edit = ("Length", None, float(self.dl["Length"].text()))
         elif element.PassMethod != self.dl["PassMethod"].text():
-            element.PassMethod = self.dl["PassMethod"].text()
-        elif self.dl["SetPoint"][0].currentText() == "BendingAngle":
-            if round(element.BendingAngle,
-                     5) != float(self.dl["SetPoint"][1].text()):
-                element.BendingAngle = float(self.dl["SetPoint"][1].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "X Kick":
-            if round(element.KickAngle[0],
-                     5) != float(self.dl["SetPoint"][1].text()):
-                element.KickAngle[0] = float(self.dl["SetPoint"][1].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "Y Kick":
-            if round(element.KickAngle[1],
-                     5) != float(self.dl["SetPoint"][1].text()):
-                element.KickAngle[1] = float(self.dl["SetPoint"][1].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "H":
-            if round(element.H, 5) != float(self.dl["SetPoint"][1].text()):
-                element.H = float(self.dl["SetPoint"][1].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "K":
-            if round(element.K, 5) != float(self.dl["SetPoint"][1].text()):
-                element.K = float(self.dl["SetPoint"][1].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "Frequency":
-            if round(element.Frequency,
-                     5) != float(self.dl["SetPoint"][1].text()):
-                element.Frequency = float(self.dl["SetPoint"].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "Voltage":
-            if round(element.Voltage,
-                     5) != float(self.dl["SetPoint"][1].text()):
-                element.Voltage = float(self.dl["SetPoint"].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "HarmNumber":
-            if round(element.HarmNumber,
-                     5) != float(self.dl["SetPoint"][1].text()):
-                element.HarmNumber = float(self.dl["SetPoint"].text())
-            else:
-                change = False
-        elif self.dl["SetPoint"][0].currentText() == "Energy":
-            if round(element.Energy,
-                     5) != float(self.dl["SetPoint"][1].text()):
-                element.Energy = float(self.dl["SetPoint"].text())
-            else:
-                change = False
-        else:
-            change = False
-        if change:
-            atip.utils.trigger_calc(self._atsim)
-            self._atsim.wait_for_calculations()
-            self.parent_window.refresh_all()
+            edit = ("PassMethod", None, self.dl["PassMethod"].text())
+        elif set_point in ["X Kick", "Y Kick"]:
+            cell = 0 if set_point == "X Kick" else 1
+            value = float(self.dl["SetPoint"][1].text())
+            if round(element.KickAngle[cell], 5) != value:
+                edit = ("KickAngle", cell, value)
+        elif set_point in ["BendingAngle", "H", "K", "Frequency", "Voltage",
+                           "HarmNumber", "Energy"]:
+            value = float(self.dl["SetPoint"][1].text())
+            if round(getattr(element, set_point), 5) != value:
+                edit = (set_point, None, value)
+        if edit is not None:
+            self.parent_window.edit_element(index, *edit)
 
     def change_list_item(self):
         """Update the displayed data for the new field selection.
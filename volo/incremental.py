@@ -0,0 +1,268 @@
+import hashlib
+from collections import OrderedDict
+
+import at
+import numpy
+
+
+def _fingerprint(element):
+    """Return a hashable key made from the type and parameters of an element,
+    so that elements with identical parameters share a transfer matrix.
+    """
+    items = []
+    for key, value in sorted(vars(element).items()):
+        if key in ['FamName', 'Index']:
+            continue  # don't affect the transfer matrix
+        if isinstance(value, numpy.ndarray):
+            value = (value.dtype.str, value.shape, value.tobytes())
+        elif isinstance(value, list):
+            value = repr(value)
+        items.append((key, value))
+    return (type(element).__name__, tuple(items))
+
+
+def lattice_digest(lattice):
+    """Return a hex digest of the types and parameters of every element of
+    the lattice, in order, which only changes if the optics could.
+    """
+    digest = hashlib.sha1()
+    for element in lattice:
+        digest.update(repr(_fingerprint(element)).encode())
+    return digest.hexdigest()
+
+
+def has_orbit_sources(lattice):
+    """Return True if any element of the lattice could displace the closed
+    orbit from zero, i.e. it has a kick, a dipole field error, or an offset.
+    """
+    for elem in lattice:
+        for attr in ['KickAngle', 'T1', 'T2']:
+            if numpy.any(numpy.asarray(getattr(elem, attr, 0.0)) != 0):
+                return True
+        for attr in ['PolynomA', 'PolynomB']:
+            poly = getattr(elem, attr, None)
+            if (poly is not None) and (len(poly) > 0) and (poly[0] != 0):
+                return True
+    return False
+
+
+class IncrementalOptics(object):
+    """Incremental linear optics engine for a lattice.
+
+    The 6x6 transfer matrix of each element is cached, keyed by that
+    element's parameters, and the matrices are combined in a segment tree
+    whose root is the one-turn map. After a change to k elements only their
+    matrices and their O(k log N) ancestors in the tree need recalculating,
+    and the optics at each refpt then costs O(log N) matrix products.
+    N.B. the optics are calculated around a zero closed orbit without
+    radiation, so they are only valid for lattices without orbit distortion,
+    see has_orbit_sources; chromaticity is not calculated, use at.linopt for that.
+    """
+    def __init__(self, lattice, max_cache=None):
+        """The lattice's radiation is switched off. max_cache is the maximum
+        number of distinct element matrices to keep, by default four per
+        element in the lattice.
+        """
+        self.lattice = lattice
+        self.lattice.radiation_off()
+        self.max_cache = max_cache
+        self.n_matrices = 0  # number of element matrices calculated
+        self._build()
+
+    def _build(self):
+        """(Re)build the segment tree from scratch for the current lattice.
+        """
+        self.n_elements = len(self.lattice)
+        size = 1
+        while size < self.n_elements:
+            size *= 2
+        self._size = size
+        self._tree = numpy.tile(numpy.eye(6), (2 * size, 1, 1))
+        self._keys = [None] * self.n_elements
+        self._matrices = OrderedDict()
+        self._lengths = numpy.zeros(self.n_elements)
+        self._positions = {}  # element id -> indices it appears at
+        for index, elem in enumerate(self.lattice):
+            self._positions.setdefault(id(elem), []).append(index)
+        for index in range(self.n_elements):
+            self._set_leaf(index)
+        self._rebuild_nodes()
+
+    def _element_matrix(self, element, key):
+        """Return the cached transfer matrix for an element, calculating it if
+        it is not already known.
+        """
+        try:
+            matrix = self._matrices.pop(key)
+        except KeyError:
+            matrix = at.find_elem_m66(element)
+            self.n_matrices += 1
+        self._matrices[key] = matrix  # most recently used at the end
+        max_cache = self.max_cache or 4 * self.n_elements
+        while len(self._matrices) > max_cache:
+            self._matrices.popitem(last=False)
+        return matrix
+
+    def _set_leaf(self, index):
+        """Update the leaf for the element at index, returning True if its
+        parameters changed.
+        """
+        element = self.lattice[index]
+        key = _fingerprint(element)
+        if key == self._keys[index]:
+            return False
+        self._keys[index] = key
+        self._tree[self._size + index] = self._element_matrix(element, key)
+        self._lengths[index] = element.Length
+        return True
+
+    def _rebuild_nodes(self):
+        """Recalculate every internal node of the tree, one level at a time.
+        """
+        level = self._size // 2
+        while level >= 1:
+            nodes = numpy.arange(level, 2 * level)
+            self._tree[nodes] = numpy.matmul(self._tree[2 * nodes + 1],
+                                             self._tree[2 * nodes])
+            level //= 2
+
+    def _update_nodes(self, indices):
+        """Recalculate the ancestors of the given leaves.
+        """
+        nodes = numpy.unique((numpy.asarray(indices) + self._size) // 2)
+        while len(nodes) > 0 and nodes[-1] >= 1:
+            self._tree[nodes] = numpy.matmul(self._tree[2 * nodes + 1],
+                                             self._tree[2 * nodes])
+            if nodes[-1] == 1:
+                break
+            nodes = numpy.unique(nodes // 2)
+
+    def invalidate(self, indices):
+        """Update the engine after the elements at indices have been changed.
+        Other positions at which the same element objects appear are updated
+        too.
+        """
+        if len(self.lattice) != self.n_elements:
+            self._build()
+            return
+        changed = set()
+        for index in indices:
+            index = int(index)
+            for pos in self._positions.get(id(self.lattice[index]), [index]):
+                if self._set_leaf(pos):
+                    changed.add(pos)
+        if changed:
+            self._update_nodes(sorted(changed))
+
+    def refresh(self):
+        """Compare every element against its cached parameters and update
+        those that have changed; used when it is not known which elements have
+        been changed, e.g. after a callable variable has been applied.
+        """
+        if len(self.lattice) != self.n_elements:
+            self._build()
+            return
+        changed = [index for index in range(self.n_elements)
+                   if self._set_leaf(index)]
+        if len(changed) > self._size // 4:
+            self._rebuild_nodes()
+        elif changed:
+            self._update_nodes(changed)
+
+    def product(self, start, stop):
+        """Return the transfer matrix from the entrance of element start to
+        the entrance of element stop.
+        """
+        left = numpy.eye(6)
+        right = numpy.eye(6)
+        start += self._size
+        stop += self._size
+        while start < stop:
+            if start & 1:
+                left = numpy.dot(self._tree[start], left)
+                start += 1
+            if stop & 1:
+                stop -= 1
+                right = numpy.dot(right, self._tree[stop])
+            start //= 2
+            stop //= 2
+        return numpy.dot(right, left)
+
+    def one_turn_matrix(self):
+        """Return the 6x6 one-turn map at the entrance of the lattice.
+        """
+        return self._tree[1].copy()
+
+    def linopt(self, refpts=None):
+        """Return (lindata0, tune, chrom, lindata) in the same format as
+        at.linopt(ring, refpts=refpts, coupled=False); chrom is always NaN.
+        """
+        if refpts is None:
+            refpts = []
+        refpts = numpy.asarray(refpts, dtype=int).reshape(-1)
+        m66 = self._tree[1]
+        m44 = m66[:4, :4]
+        beta0 = numpy.zeros(2)
+        alpha0 = numpy.zeros(2)
+        tune = numpy.zeros(2)
+        for plane in range(2):
+            m = m44[2 * plane:2 * plane + 2, 2 * plane:2 * plane + 2]
+            cos_mu = (m[0, 0] + m[1, 1]) / 2.0
+            if abs(cos_mu) >= 1.0:
+                beta0[plane] = alpha0[plane] = tune[plane] = numpy.nan
+                continue
+            sin_mu = numpy.sign(m[0, 1]) * numpy.sqrt(1.0 - cos_mu**2)
+            beta0[plane] = m[0, 1] / sin_mu
+            alpha0[plane] = (m[0, 0] - m[1, 1]) / (2.0 * sin_mu)
+            tune[plane] = (numpy.arctan2(sin_mu, cos_mu) / (2 * numpy.pi)) % 1
+        try:
+            eta0 = numpy.linalg.solve(numpy.eye(4) - m44, m66[:4, 4])
+        except numpy.linalg.LinAlgError:
+            eta0 = numpy.full(4, numpy.nan)
+        s_pos = numpy.concatenate(([0.0], numpy.cumsum(self._lengths)))
+        lindata0 = self._lindata(numpy.zeros(1, dtype=int), [numpy.eye(6)],
+                                 beta0, alpha0, eta0, s_pos)[0]
+        matrices = []
+        previous = 0
+        transfer = numpy.eye(6)
+        for ref in refpts:
+            transfer = numpy.dot(self.product(previous, ref), transfer)
+            matrices.append(transfer)
+            previous = ref
+        lindata = self._lindata(refpts, matrices, beta0, alpha0, eta0, s_pos)
+        return lindata0, tune, numpy.array([numpy.nan, numpy.nan]), lindata
+
+    def _lindata(self, refpts, matrices, beta0, alpha0, eta0, s_pos):
+        """Propagate the periodic optics at the entrance of the lattice
+        through the transfer matrices to refpts.
+        """
+        n = len(refpts)
+        lindata = numpy.recarray(n, dtype=[
+            ('alpha', numpy.float64, (2,)), ('beta', numpy.float64, (2,)),
+            ('mu', numpy.float64, (2,)), ('dispersion', numpy.float64, (4,)),
+            ('closed_orbit', numpy.float64, (6,)),
+            ('m44', numpy.float64, (4, 4)), ('gamma', numpy.float64),
+            ('s_pos', numpy.float64), ('idx', numpy.uint32)
+        ])
+        if n == 0:
+            return lindata
+        matrices = numpy.array(matrices)
+        for plane in range(2):
+            r = matrices[:, 2 * plane:2 * plane + 2, 2 * plane:2 * plane + 2]
+            a = r[:, 0, 0] * beta0[plane] - r[:, 0, 1] * alpha0[plane]
+            b = r[:, 1, 0] * beta0[plane] - r[:, 1, 1] * alpha0[plane]
+            lindata.beta[:, plane] = (a**2 + r[:, 0, 1]**2) / beta0[plane]
+            lindata.alpha[:, plane] = -(a * b + r[:, 0, 1] * r[:, 1, 1]) / \
+                beta0[plane]
+            # phase only ever advances, so unwrap it to [0, 2pi) steps
+            mu = numpy.arctan2(r[:, 0, 1], a)
+            steps = numpy.diff(numpy.concatenate(([0.0], mu))) % (2 * numpy.pi)
+            lindata.mu[:, plane] = numpy.cumsum(steps)
+        lindata.dispersion = (numpy.dot(matrices[:, :4, :4], eta0) +
+                              matrices[:, :4, 4])
+        lindata.closed_orbit = 0.0
+        lindata.m44 = matrices[:, :4, :4]
+        lindata.gamma = 1.0
+        lindata.s_pos = s_pos[refpts]
+        lindata.idx = refpts
+        return lindata
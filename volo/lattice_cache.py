@@ -0,0 +1,128 @@
+"""On-disk cache of parsed lattices and their initial optics.
+
+Parsing a Tracy file, or loading one of atip's rings, is slow, so the parsed
+lattice is pickled and its initial linear optics saved as a .npy file that
+is memory-mapped when it is loaded again. Entries are keyed by the content
+hash of the source file, which is only recalculated when the file's path,
+mtime or size change, and by the loader used, so editing the source file
+invalidates its entry automatically.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+import at
+import numpy
+
+# Bump to invalidate every existing entry if the entry format changes
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'volo',
+                                 'lattices')
+LOADERS = {'.lat': at.load_tracy, '.mat': at.load_mat}
+
+
+def _content_hash(path, cache_dir):
+    """Return the sha1 of the file at path, only rereading it if its mtime or
+    size have changed since the hash was stored in the cache's index.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    index_path = os.path.join(cache_dir, 'index.json')
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {}
+    known = index.get(path)
+    if known and (known['mtime_ns'] == stat.st_mtime_ns and
+                  known['size'] == stat.st_size):
+        return known['sha1']
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    index[path] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                   'sha1': digest.hexdigest()}
+    _write_atomic(index_path, json.dumps(index).encode())
+    return digest.hexdigest()
+
+
+def _write_atomic(path, data):
+    # A temporary file per process, so concurrent loads can't collide
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def _initial_optics(lattice):
+    """Return (tune, chrom, lindata at every element) for the lattice, or None
+    if it is unstable.
+    """
+    try:
+        _, tune, chrom, lindata = at.linopt(lattice, refpts=range(len(lattice)
+                                                                   + 1),
+                                            get_chrom=True, coupled=False)
+    except Exception:
+        return None
+    if not numpy.all(numpy.isfinite(tune)):
+        return None
+    return tune, chrom, lindata
+
+
+def load(path, loader=None, cache_dir=None, optics=False, **kwargs):
+    """Return the lattice in the file at path, from the cache if it is there,
+    otherwise loaded by loader(path, **kwargs), by default chosen by the
+    file's extension from LOADERS, and then cached. If optics is True return
+    (lattice, (tune, chrom, lindata)) instead, where lindata, from linopt at
+    every element, is read-only and memory-mapped, and the optics are None
+    if the lattice is unstable. Each call returns a new copy of the lattice,
+    which may be changed freely. If the file doesn't exist, e.g. because
+    loader doesn't read it, the lattice is loaded without the cache.
+    """
+    if loader is None:
+        loader = LOADERS[os.path.splitext(path)[1]]
+    if not os.path.isfile(path):
+        lattice = loader(path, **kwargs)
+        return (lattice, _initial_optics(lattice)) if optics else lattice
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha1(repr((
+        CACHE_VERSION, _content_hash(path, cache_dir),
+        getattr(loader, '__module__', None),
+        getattr(loader, '__qualname__', repr(loader)), sorted(kwargs.items())
+    )).encode()).hexdigest()
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(entry + '.pkl', 'rb') as f:
+            lattice, tune, chrom = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        lattice = loader(path, **kwargs)
+        initial = _initial_optics(lattice)
+        tune = chrom = None
+        if initial is not None:
+            tune, chrom, lindata = initial
+            temporary = '{0}.optics.{1}.tmp'.format(entry, os.getpid())
+            with open(temporary, 'wb') as f:
+                numpy.save(f, numpy.asarray(lindata))
+            os.replace(temporary, entry + '.optics.npy')
+        _write_atomic(entry + '.pkl', pickle.dumps((lattice, tune, chrom),
+                                                   pickle.HIGHEST_PROTOCOL))
+    if not optics:
+        return lattice
+    if tune is None:
+        return lattice, None
+    lindata = numpy.load(entry + '.optics.npy', mmap_mode='r')
+    return lattice, (tune, chrom, lindata.view(numpy.recarray))
+
+
+def load_atip(name, cache_dir=None, optics=False):
+    """Return one of atip's rings, e.g. 'DIAD', as atip.utils.load_at_lattice
+    does, through the cache; the ring's .mat file in atip is the source.
+    """
+    import atip.utils  # only needed for atip's rings
+    path = os.path.join(os.path.dirname(atip.__file__), 'rings',
+                        name + '.mat')
+    return load(path, lambda path: atip.utils.load_at_lattice(name),
+                cache_dir, optics)
@@ -8,6 +8,7 @@ import at.plot
 import atip
 import math
 import numpy
+import lattice_cache
 import optimizer
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
@@ -20,7 +21,7 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QGroupBox, QWidget,
 class Window(QMainWindow):
     def __init__(self, parent=None):
         super(Window, self).__init__(parent)
-        self.lattice = atip.utils.load_at_lattice('DIAD')
+        self.lattice = lattice_cache.load_atip('DIAD')
         self.initUI()
 
     def initUI(self):
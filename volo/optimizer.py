@@ -1,6 +1,49 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+
 import at
 import numpy
-from scipy.optimize import least_squares
+from scipy.optimize import (OptimizeResult, differential_evolution,
+                            least_squares)
+from scipy.stats import qmc
+
+from incremental import IncrementalOptics, has_orbit_sources, lattice_digest
+from radiation import dipole_indices, radiation_integrals, radiation_parameters
+from snapshot import ParameterStore
+from stats import EvaluationStats
+
+GLOBAL_FIELDS = ['tune_x', 'tune_y', 'chrom_x', 'chrom_y']
+# Global fields from the radiation integrals, see radiation.py
+RADIATION_FIELDS = ['emittance', 'energy_spread', 'momentum_compaction',
+                    'partition_x', 'partition_e']
+# Local fields as (lindata attribute, column), a column of None takes them all
+LOCAL_FIELDS = {'beta_x': ('beta', 0), 'beta_y': ('beta', 1),
+                'mu_x': ('mu', 0), 'mu_y': ('mu', 1),
+                'eta_x': ('dispersion', 0), 'eta_px': ('dispersion', 1),
+                'eta_y': ('dispersion', 2), 'eta_py': ('dispersion', 3),
+                'dispersion': ('dispersion', None), 'gamma': ('gamma', None),
+                'alpha_x': ('alpha', 0), 'alpha_y': ('alpha', 1),
+                'x': ('closed_orbit', 0), 'px': ('closed_orbit', 1),
+                'y': ('closed_orbit', 2), 'py': ('closed_orbit', 3)}
+
+
+def _is_orbit_field(field):
+    """Return True if a variable's field could displace the closed orbit from
+    zero, i.e. it is a kick, a dipole field error, or an offset. What a
+    callable field changes can't be known, so it isn't counted.
+    """
+    if callable(field):
+        return False
+    if isinstance(field, str):
+        return field in ['KickAngle', 'T1', 'T2', 'PolynomA', 'PolynomB']
+    return ((field[0] in ['KickAngle', 'T1', 'T2']) or
+            ((field[0] in ['PolynomA', 'PolynomB']) and (field[1] == 0)))
 
 
 class Variables(object):
@@ -11,6 +54,10 @@ class Variables(object):
         or a callable to be called in the format func(lattice, index, value)
         to make a custom change to the lattice. To change mutiple fields on
         the same element, multiple field index pairs must be passed.
+        For non-callable fields an index may also be a family name(string,
+        which may contain the wildcards * and ?) to set that field on every
+        element of the family, e.g. the field ['PolynomB', 1] with the index
+        'qf1'; the family is only searched for once per Constraints object.
         Values need to be in phys units!
         """
         if (len(fields) != len(indices)) or (len(fields) != len(values)):
@@ -36,7 +83,8 @@ class Variables(object):
 
 
 class Constraints(object):
-    def __init__(self, lattice, constraints):
+    def __init__(self, lattice, constraints, incremental=False,
+                 closed_orbit=None, cache_size=0, superperiods=None):
         """Constraints is a dictionary with format:
             {field: [[refpts], [desired_values], [weights]]}
         where refpts is an ordered ascending list of integers, desired_values
@@ -50,17 +98,61 @@ class Constraints(object):
         N.B. for global fields refpts should not be given as they are ignored.
         N.B. if you are using a custom difference function that only returns a
         single value or a global field, then weights should be a length 1 list.
+        If incremental is True the linear optics are calculated by an
+        IncrementalOptics engine, which only recalculates the transfer matrices
+        of the elements that make_changes alters, unless the plan needs
+        chromaticity or the closed orbit, which still need at.linopt.
+        The plan of which optics calculations each merit evaluation needs is
+        made from the constraint fields, see make_plan, and kept in plan.
+        closed_orbit forces (True) or skips (False) the closed orbit search;
+        by default it is only done if the lattice has kicks or offsets, there
+        are closed orbit constraints, or the variables could change kicks or
+        offsets, see check_orbit_sources.
+        If cache_size is greater than 0, the lindata and residuals of up to
+        that many evaluations are kept, keyed by the exact variable values,
+        with the least recently used evicted first; cache_hits and
+        cache_misses count how often it is used.
+        The fields in RADIATION_FIELDS are global fields found from the
+        synchrotron radiation integrals, which are calculated from the optics
+        at the entrance of every dipole, so they cost about as much as beta
+        constraints rather than needing radiation tracking.
+        The time spent in each stage of every evaluation, 'make_changes',
+        'cache', 'optics', 'fields' (the residuals of the lindata fields),
+        'callables', 'assembly' and in total 'evaluate', is recorded in the
+        EvaluationStats object stats.
+        Periodic lattices: if the lattice has a periodicity attribute it is
+        taken to be one of that many identical superperiods, as in pyat, so
+        its tunes and chromaticities are scaled up to those of the whole
+        ring. If superperiods is given the lattice is the whole ring, made
+        of that many identical superperiods, and the optics are only
+        calculated for the first of them, in cell, and scaled likewise; local
+        refpts must then be within the first superperiod, and only family
+        variables, which change every superperiod alike, may be used.
+        periodicity is the total number of superperiods in the ring.
         """
         self.lattice = lattice
+        self.periodicity = int(getattr(lattice, 'periodicity', 1) or 1)
+        self.superperiods = superperiods or 1
+        if self.superperiods > 1:
+            if len(lattice) % self.superperiods != 0:
+                raise ValueError("A lattice of {0} elements can't be split "
+                                 "into {1} identical superperiods."
+                                 .format(len(lattice), self.superperiods))
+            self.cell = lattice[:len(lattice) // self.superperiods]
+            self.periodicity *= self.superperiods
+        else:
+            self.cell = lattice
         self.refpts = set()
         for key in constraints.keys():
             refpts, desired_values, weights = constraints[key]
-            if key in ['tune_x', 'tune_y', 'chrom_x', 'chrom_y']:
+            if (key in GLOBAL_FIELDS) or (key in RADIATION_FIELDS):
                 if len(weights) > 1:
                     raise IndexError("Global fields ({0}) may only have one "
                                      "weighting value per field.".format(key))
             elif callable(key):
                 pass
+            elif key not in LOCAL_FIELDS:
+                raise KeyError("Unsupported constraint field {0}.".format(key))
             else:
                 if (len(weights)>1) and (len(refpts) != len(weights)):
                     raise IndexError("Field {0}: List of weights must be of "
@@ -70,65 +162,274 @@ class Constraints(object):
                     raise IndexError("Field {0}: List of desired_values must "
                                      "be the same length as refpts."
                                      .format(key))
-            self.refpts.update(refpts)
+                if max(refpts or [0]) > len(self.cell):
+                    raise IndexError("Field {0}: refpts must be within the "
+                                     "first superperiod, i.e. at most {1}."
+                                     .format(key, len(self.cell)))
+                self.refpts.update(refpts)  # only local fields need refpts
+        self.radiation = any([key in RADIATION_FIELDS
+                              for key in constraints.keys()])
+        self._radiation_lindata = None
+        if self.radiation:
+            # the optics at the dipoles' entrances and the circumference
+            self.dipoles = dipole_indices(self.cell)
+            self.refpts.update(self.dipoles)
+            self.refpts.add(len(self.cell))
         self.refpts = list(self.refpts)
         self.refpts.sort()
         self.desired_constraints = constraints
+        self.layout = self._build_layout()
+        self._families = {}  # family name -> element indices
+        self.n_linopt = 0
+        self._symmetric = None  # the variables that were checked last
+        self._closed_orbit = closed_orbit
+        self._orbit_checked = None  # likewise for check_orbit_sources
+        if incremental:
+            self.optics = IncrementalOptics(self.cell)
+        else:
+            self.optics = None
+        self.plan = self.make_plan(closed_orbit)
+        self.cache_size = cache_size
+        self.clear_cache()
+        self.stats = EvaluationStats()
+
+    def make_plan(self, closed_orbit=None):
+        """Choose the cheapest set of optics calculations that provides every
+        constrained field, and return it as a dictionary:
+            'stages': which of 'tunes', 'twiss' (at refpts), 'chromaticity',
+                      'radiation_integrals' and 'closed_orbit' are
+                      calculated,
+            'engine': 'linopt', 'incremental', or None if only callable
+                      constraints are present,
+            'n_refpts': the number of refpts the twiss is calculated at,
+            'get_chrom', 'closed_orbit': the flags passed on to the engine,
+            'periodicity': the number of superperiods the tunes and
+                           chromaticities of one are scaled up by.
+        Chromaticity needs off momentum closed orbits and extra tracking, so
+        it is only calculated for chrom_x and chrom_y constraints. If the plan
+        is changed, e.g. closed_orbit is forced, assign the result to plan.
+        """
+        keys = [key for key in self.desired_constraints.keys()
+                if not callable(key)]
+        get_chrom = any([key in ['chrom_x', 'chrom_y'] for key in keys])
+        if closed_orbit is None:
+            closed_orbit = (any([key in ['x', 'px', 'y', 'py']
+                                 for key in keys]) or
+                            has_orbit_sources(self.lattice))
+        stages = []
+        if keys:
+            stages.append('tunes')
+            if self.refpts:
+                stages.append('twiss')
+            if get_chrom:
+                stages.append('chromaticity')
+            if self.radiation:
+                stages.append('radiation_integrals')
+            if closed_orbit:
+                stages.append('closed_orbit')
+        if not keys:
+            engine = None
+        elif (self.optics is not None) and not (get_chrom or closed_orbit):
+            engine = 'incremental'
+        else:
+            engine = 'linopt'
+        return {'stages': stages, 'engine': engine,
+                'n_refpts': len(self.refpts), 'get_chrom': get_chrom,
+                'closed_orbit': bool(closed_orbit),
+                'periodicity': self.periodicity}
+
+    def _build_layout(self):
+        """Precompute, for each constraint, the positions of its refpts in the
+        lindata, its desired values and weights as arrays, and the slice of
+        the residual vector it fills.
+        """
+        refpts = numpy.array(self.refpts, dtype=int)
+        layout = []
+        start = 0
+        for key, (refs, desired_values, weights) in \
+                self.desired_constraints.items():
+            entry = {'key': key}
+            if not callable(key):
+                desired = numpy.array(desired_values, dtype=float)
+                weights = numpy.array(weights, dtype=float)
+                if key in GLOBAL_FIELDS:
+                    n = GLOBAL_FIELDS.index(key)
+                    entry['item'] = (1 + n // 2, n % 2)
+                    desired = desired.reshape(1)
+                elif key in RADIATION_FIELDS:
+                    entry['item'] = ('radiation', key)
+                    desired = desired.reshape(1)
+                else:
+                    entry['item'] = LOCAL_FIELDS[key]
+                    entry['positions'] = numpy.searchsorted(refpts, refs)
+                    # broadcast the weights over any per refpt vectors
+                    weights = weights.reshape((-1,) + (1,) *
+                                              (desired.ndim - 1))
+                entry['desired'] = desired
+                entry['weights'] = weights
+                entry['start'] = start
+                entry['stop'] = start + desired.size
+                start += desired.size
+            layout.append(entry)
+        self.n_residuals = start
+        self._residuals = numpy.empty(start)
+        self._callables = any([callable(entry['key']) for entry in layout])
+        return layout
 
-    def calc_lindata(self):
-        self.lattice.radiation_off()
-        return at.linopt(self.lattice, refpts=self.refpts, get_chrom=True,
-                         coupled=False)
+    def calc_lindata(self, refpts=None, get_chrom=None):
+        """Run linopt on the lattice, following the plan, at the constraints'
+        refpts unless another list of refpts is given; get_chrom overrides
+        the plan's choice. n_linopt counts the calls, whether they are
+        answered by at.linopt or the incremental optics engine. Only cell,
+        one superperiod, is calculated and the tunes and chromaticities are
+        scaled to those of the whole ring.
+        """
+        if refpts is None:
+            refpts = self.refpts
+        if get_chrom is None:
+            get_chrom = self.plan['get_chrom']
+        self.n_linopt += 1
+        if (self.plan['engine'] == 'incremental') and (not get_chrom):
+            lindata = self.optics.linopt(refpts)
+        else:
+            self.cell.radiation_off()
+            kwargs = {}
+            if not self.plan['closed_orbit']:
+                kwargs['orbit'] = numpy.zeros(6)  # skip the orbit search
+            lindata = at.linopt(self.cell, refpts=refpts, get_chrom=get_chrom,
+                                coupled=False, **kwargs)
+        if self.periodicity == 1:
+            return lindata
+        lindata0, tune, chrom, data = lindata
+        return (lindata0, (numpy.asarray(tune) * self.periodicity) % 1,
+                numpy.asarray(chrom) * self.periodicity, data)
 
     def convert_lindata(self, lindata):
         """Fields : ['tune_x', 'tune_y', 'chrom_x', 'chrom_y', 'beta_x',
                      'beta_y', 'mu_x', 'mu_y', 'eta_x', 'eta_px', 'eta_y',
                      'eta_py', 'dispersion', 'gamma' 'alpha_x', 'alpha_y',
-                     'x', 'px', 'y', 'py']
-        Emittance could possibly be added, though it would increase the
-        calculation time dramatically.
-        """
-        data_map = {
-            'tune_x': lindata[1][0], 'tune_y': lindata[1][1],
-            'chrom_x': lindata[2][0], 'chrom_y': lindata[2][1],
-            'beta_x': lindata[3].beta[:, 0], 'beta_y': lindata[3].beta[:, 1],
-            'mu_x': lindata[3].mu[:, 0], 'mu_y': lindata[3].mu[:, 1],
-            'eta_x': lindata[3].dispersion, 'eta_px': lindata[3].dispersion,
-            'eta_y': lindata[3].dispersion, 'eta_py': lindata[3].dispersion,
-            'dispersion': lindata[3].dispersion, 'gamma': lindata[3].gamma,
-            'alpha_x': lindata[3].alpha[:, 0],
-            'alpha_y': lindata[3].alpha[:, 1],
-            'x': lindata[3].closed_orbit[:, 0],
-            'px': lindata[3].closed_orbit[:, 1],
-            'y': lindata[3].closed_orbit[:, 2],
-            'py': lindata[3].closed_orbit[:, 3]
-        }
+                     'x', 'px', 'y', 'py', 'emittance', 'energy_spread',
+                     'momentum_compaction', 'partition_x', 'partition_e']
+        The radiation fields come from the radiation integrals rather than
+        radiation tracking, so they don't increase the calculation time
+        dramatically.
+        """
         data = {}
-        for key in self.desired_constraints.keys():
-            if callable(key):
-                pass
-            elif key in ['tune_x', 'tune_y', 'chrom_x', 'chrom_y']:
-                data[key] = numpy.array([data_map[key]])  # global fields
-            else:
-                data[key] = numpy.array([data_map[key][self.refpts.index(ref)]
-                                         for ref in
-                                         self.desired_constraints[key][0]])
+        for entry in self.layout:
+            if not callable(entry['key']):
+                data[entry['key']] = self._field_values(lindata, entry)
         return data
 
+    def _field_values(self, lindata, entry):
+        """Return the values of a constraint's field at its refpts, selected
+        from the lindata with the precomputed index arrays.
+        """
+        if 'positions' not in entry:  # global field
+            item, column = entry['item']
+            if item == 'radiation':
+                return numpy.array([self.radiation_values(lindata)[column]])
+            return numpy.array([lindata[item][column]])
+        attribute, column = entry['item']
+        values = getattr(lindata[3], attribute)
+        if column is None:
+            return values[entry['positions']]
+        return values[entry['positions'], column]
+
+    def radiation_values(self, lindata):
+        """Return the radiation parameters, see radiation_parameters, for the
+        lindata of an evaluation; they are only calculated once per lindata.
+        """
+        if self._radiation_lindata is not lindata:
+            entrance = lindata[3][numpy.searchsorted(self.refpts,
+                                                     self.dipoles)]
+            circumference = lindata[3].s_pos[-1]
+            self._radiation_values = radiation_parameters(
+                radiation_integrals(self.cell, self.dipoles, entrance),
+                self.lattice.energy, circumference
+            )
+            self._radiation_lindata = lindata
+        return self._radiation_values
+
+    def resolve(self, index):
+        """Return the element indices that a variable's index refers to;
+        either the index itself, or for a family name the indices of every
+        element in the family, which are found once and then cached.
+        """
+        if not isinstance(index, str):
+            return [index]
+        if index in self._families:
+            return self._families[index]
+        indices = [i for i, elem in enumerate(self.lattice)
+                   if fnmatchcase(elem.FamName, index)]
+        if not indices:
+            raise KeyError("No elements found in family {0}.".format(index))
+        self._families[index] = indices
+        return indices
+
+    def check_orbit_sources(self, variables):
+        """Add the closed orbit search to the plan if the variables could
+        displace the orbit from zero, even if they don't yet, e.g. kicks that
+        start at zero, unless closed_orbit was given. Called by make_changes
+        the first time it is given each variables object. Callable fields
+        aren't checked, so pass closed_orbit=True if they change kicks or
+        offsets.
+        """
+        if self._orbit_checked is variables:
+            return
+        self._orbit_checked = variables
+        if ((self._closed_orbit is None) and
+                (not self.plan['closed_orbit']) and
+                any([_is_orbit_field(f) for f in variables.fields])):
+            self.plan = self.make_plan(True)
+            self.clear_cache()
+
     def make_changes(self, values, variables):
         """Apply a change to an element. The values come from the optimizer,
         and the fields and element indexes come from the variables object. If
         the field is callable it will be called as func(lattice, index, value).
+        If the index is a family name the change is applied to every element
+        of the family.
         """
+        lattice = self.lattice
+        if (self.superperiods > 1) and (self._symmetric is not variables):
+            if not all([(not callable(f)) and isinstance(i, str)
+                        for f, i in zip(variables.fields,
+                                        variables.indices)]):
+                raise ValueError("Only family variables keep the "
+                                 "superperiods identical.")
+            self._symmetric = variables
+        self.check_orbit_sources(variables)
+        changed = []
+        unknown_changes = False
         for v, f, i in zip(values, variables.fields, variables.indices):
             if callable(f):
-                f(self.lattice, i, v)
+                f(lattice, i, v)
+                unknown_changes = True
             elif isinstance(f, str):
-                vars(self.lattice[i])[f] = v
+                indices = self.resolve(i)
+                for index in indices:
+                    vars(lattice[index])[f] = v
+                changed.extend(indices)
             else:
                 field = f[0]
                 cell = f[1]
-                vars(self.lattice[i])[field][cell] = v
+                indices = self.resolve(i)
+                for index in indices:
+                    vars(lattice[index])[field][cell] = v
+                changed.extend(indices)
+        if self.optics is not None:
+            if unknown_changes:
+                self.optics.refresh()
+            else:
+                self.optics.invalidate([index for index in changed
+                                        if index < len(self.cell)])
+
+    def clear_cache(self):
+        """Empty the evaluation cache and reset its counters.
+        """
+        self._cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def merit_function(self, values, variables, **kwargs):
         """Determine the difference between the constraints' current and goal
@@ -136,22 +437,444 @@ class Constraints(object):
         is used it will be called as func(lattice, constraint, kwargs), where
         lattice is the current version of the lattice, and constraint is the
         constraint for which the callable was passed as a field.
+        The residuals of the lindata fields are written into a preallocated
+        buffer, and a copy of it is returned.
         """
+        return self.evaluate(values, variables, **kwargs)[1]
+
+    def evaluate(self, values, variables, **kwargs):
+        """Apply the values to the lattice and return (lindata, residuals),
+        from the cache if these values have been evaluated before; lindata is
+        None if there are only callable constraints. The time taken by each
+        stage is recorded in stats.
+        """
+        stats = self.stats
+        profiler = stats.start_profile()
+        start = clock = time.perf_counter()
         self.make_changes(values, variables)
-        if not all([callable(key) for key in self.desired_constraints.keys()]):
-            constraints = self.convert_lindata(self.calc_lindata())
-        residuals = []
-        for key in self.desired_constraints.keys():
+        clock = self._lap(stats, 'make_changes', clock)
+        if self.cache_size > 0:
+            cache_key = (id(variables),
+                         numpy.asarray(values, dtype=float).tobytes(),
+                         repr(sorted(kwargs.items())))
+            if cache_key in self._cache:
+                self.cache_hits += 1
+                self._cache.move_to_end(cache_key)
+                lindata, residuals = self._cache[cache_key]
+                self._lap(stats, 'cache', clock)
+                self._finish(stats, profiler, start)
+                return lindata, residuals.copy()
+            self.cache_misses += 1
+            clock = self._lap(stats, 'cache', clock)
+        lindata = None
+        if self.plan['engine'] is not None:
+            lindata = self.calc_lindata()
+            clock = self._lap(stats, 'optics', clock)
+        parts = []
+        callables_time = 0.0
+        for entry in self.layout:
+            key = entry['key']
             if callable(key):
+                call_start = time.perf_counter()
                 diff = key(self.lattice, self.desired_constraints[key],
                            **kwargs)
+                callables_time += time.perf_counter() - call_start
+                parts.append(numpy.ravel(numpy.asarray(diff, dtype=float) *
+                                         numpy.asarray(self.desired_constraints
+                                                       [key][2], dtype=float)))
             else:
-                diff = constraints[key] - self.desired_constraints[key][1]
-            try:  # array
-                residuals.extend(diff * self.desired_constraints[key][2])
-            except TypeError:  # scalar
-                residuals.append(diff * self.desired_constraints[key][2])
-        return residuals
+                out = self._residuals[entry['start']:entry['stop']]
+                out = out.reshape(entry['desired'].shape)
+                numpy.subtract(self._field_values(lindata, entry),
+                               entry['desired'], out=out)
+                out *= entry['weights']
+                parts.append(self._residuals[entry['start']:entry['stop']])
+        if self._callables:
+            stats.record('callables', callables_time)
+        clock = self._lap(stats, 'fields', clock, callables_time)
+        if self._callables:
+            residuals = numpy.concatenate(parts)
+        else:
+            residuals = self._residuals.copy()
+        if self.cache_size > 0:
+            self._cache[cache_key] = (lindata, residuals.copy())
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        self._lap(stats, 'assembly', clock)
+        self._finish(stats, profiler, start)
+        return lindata, residuals
+
+    def _lap(self, stats, stage, clock, exclude=0.0):
+        """Record the time since clock, less exclude, for stage and return
+        the time now.
+        """
+        now = time.perf_counter()
+        stats.record(stage, now - clock - exclude)
+        return now
+
+    def _finish(self, stats, profiler, start):
+        duration = time.perf_counter() - start
+        stats.record('evaluate', duration)
+        stats.stop_profile(profiler, duration)
+
+
+_worker = {}
+
+
+def _init_worker(constraints, variables, kwargs):
+    """Keep a copy of the constraints, and therefore the lattice, resident in
+    a pool worker process.
+    """
+    _worker['cons'] = constraints
+    _worker['vars'] = variables
+    _worker['kwargs'] = kwargs
+
+
+def _worker_merit(values):
+    """Evaluate the merit function on the worker's own copy of the lattice.
+    """
+    return numpy.asarray(_worker['cons'].merit_function(
+        values, _worker['vars'], **_worker['kwargs']), dtype=float)
+
+
+def _cost(values, cons, variables, kwargs):
+    """Return half the sum of the squared residuals, as least_squares defines
+    the cost, or infinity if the lattice is unstable at values.
+    """
+    try:
+        residuals = cons.merit_function(values, variables, **kwargs)
+    except ValueError:
+        return numpy.inf
+    cost = 0.5 * numpy.dot(residuals, residuals)
+    return cost if numpy.isfinite(cost) else numpy.inf
+
+
+def _worker_cost(values):
+    """Evaluate the cost on the worker's own copy of the lattice.
+    """
+    return _cost(values, _worker['cons'], _worker['vars'], _worker['kwargs'])
+
+
+def _local_solve(cons, variables, x0, jac='2-point', processes=None,
+                 max_iters=None, verbosity=0, ftol=1e-8, xtol=1e-8, gtol=1e-8,
+                 kwargs=None, monitor=None, jac_monitor=None):
+    """Run least_squares on the constraints from x0, returning the result and
+    the Jacobian provider (or string) that was used; see Optimizer.run. If
+    given, monitor is called with the merit function and returns the
+    function to minimise in its place, and jac_monitor does the same for
+    the Jacobian provider, which is then always a callable; least_squares'
+    own finite differences are replaced by a Jacobian with analytic=False.
+    """
+    fun = cons.merit_function
+    if monitor is not None:
+        fun = monitor(fun)
+    if jac == 'analytic':
+        jac = Jacobian(cons, variables, processes=processes or 1)
+    elif jac == 'parallel':
+        jac = Jacobian(cons, variables, analytic=False,
+                       processes=processes or multiprocessing.cpu_count())
+    elif (jac_monitor is not None) and not callable(jac):
+        jac = Jacobian(cons, variables, analytic=False)
+    provider = jac
+    if jac_monitor is not None:
+        jac = jac_monitor(jac)
+    try:
+        ls = least_squares(fun, x0, jac=jac,
+                           bounds=variables.bounds, ftol=ftol, xtol=xtol,
+                           gtol=gtol, max_nfev=max_iters, verbose=verbosity,
+                           args=([variables]), kwargs=kwargs or {})
+    finally:
+        if isinstance(provider, Jacobian):
+            provider.close()
+    return ls, provider
+
+
+def _start_result(cons, variables, x0, options, kwargs):
+    """Run one local solve of a multi-start and summarise it as a dictionary;
+    starting points that can't be solved from, e.g. because the lattice is
+    unstable there, are given an infinite cost.
+    """
+    start = time.time()
+    try:
+        ls, _ = _local_solve(cons, variables, x0, kwargs=kwargs, **options)
+    except ValueError as error:
+        return {'x0': x0, 'x': x0, 'cost': numpy.inf, 'fun': None,
+                'nfev': 0, 'status': None, 'message': str(error),
+                'wall_time': time.time() - start}
+    return {'x0': x0, 'x': ls.x, 'cost': ls.cost, 'fun': ls.fun,
+            'nfev': ls.nfev, 'status': ls.status, 'message': ls.message,
+            'wall_time': time.time() - start}
+
+
+def _worker_start(task):
+    """Run one local solve of a multi-start on the worker's own lattice.
+    """
+    x0, options = task
+    return _start_result(_worker['cons'], _worker['vars'], x0, options,
+                         _worker['kwargs'])
+
+
+def _definition_name(obj):
+    """Return a name for a field or constraint key that is the same in every
+    session, unlike the repr of a function.
+    """
+    if callable(obj):
+        return "{0}.{1}".format(getattr(obj, '__module__', None),
+                                getattr(obj, '__qualname__', repr(obj)))
+    return repr(obj)
+
+
+def _focusing_functions(k, s):
+    """Return the cosine-like and sine-like solutions, C(s) and S(s), of
+    Hill's equation for constant focusing strength k at the positions s.
+    """
+    if k > 0:
+        rk = numpy.sqrt(k)
+        return numpy.cos(rk * s), numpy.sin(rk * s) / rk
+    elif k < 0:
+        rk = numpy.sqrt(-k)
+        return numpy.cosh(rk * s), numpy.sinh(rk * s) / rk
+    else:
+        return numpy.ones_like(s), s
+
+
+class Jacobian(object):
+    def __init__(self, constraints, variables, step=None, analytic=True,
+                 processes=1):
+        """A Jacobian provider for Optimizer.run, to be passed to
+        least_squares as jac. Columns for variables that are PolynomB[1]
+        (quadrupole) or PolynomB[2] (sextupole) cells of an element, or of
+        every element of a family, are calculated analytically, using first
+        order perturbation theory, from a single linopt pass. All other
+        columns, e.g. those for callable or other fields, or those that would
+        need a chromaticity derivative with respect to a quadrupole, are
+        calculated by forward finite differences with a relative step size of
+        step.
+        N.B. analytic columns are only possible if all the constraints are
+        fields in Jacobian.analytic_fields, otherwise every column will be
+        calculated by finite differences. They also assume a zero closed
+        orbit, so they are calculated by finite differences too while the
+        constraints' plan includes the closed orbit search, which is checked
+        on each call as the plan may change once the variables are seen.
+        If analytic is False every column is calculated by finite
+        differences. If processes is greater than 1 the finite difference
+        evaluations are sent to a pool of that many worker processes, each of
+        which keeps its own copy of the lattice, so that all the columns are
+        evaluated at once; call close() when finished to shut the pool down.
+        """
+        self.cons = constraints
+        self.vars = variables
+        if step is None:
+            step = numpy.sqrt(numpy.finfo(float).eps)
+        self.step = step
+        self.processes = processes
+        self._pool = None
+        self.n_calls = 0
+        self.n_fd_columns = 0
+        self.n_remote = 0
+        keys = list(self.cons.desired_constraints.keys())
+        analytic_keys = analytic and all([(not callable(key)) and
+                                          (key in self.analytic_fields)
+                                          for key in keys])
+        has_chrom = any([key in ['chrom_x', 'chrom_y'] for key in keys
+                         if not callable(key)])
+        self.orders = []
+        for f, i in zip(variables.fields, variables.indices):
+            order = None
+            if (analytic_keys and (not callable(f)) and
+                    (not isinstance(f, str)) and (f[0] == 'PolynomB') and
+                    (int(f[1]) in [1, 2])):
+                order = int(f[1])
+                if (order == 1) and has_chrom:
+                    order = None
+            self.orders.append(order)
+
+    analytic_fields = ['tune_x', 'tune_y', 'chrom_x', 'chrom_y', 'beta_x',
+                       'beta_y', 'alpha_x', 'alpha_y', 'mu_x', 'mu_y', 'eta_x',
+                       'eta_px']
+
+    def __call__(self, values, variables, **kwargs):
+        """Calculate the Jacobian of Constraints.merit_function at values; the
+        time taken is recorded as the 'jacobian' stage of the constraints'
+        stats, and includes any merit evaluations made here.
+        """
+        start = time.perf_counter()
+        self.n_calls += 1
+        values = numpy.array(values, dtype=float)
+        self.cons.make_changes(values, variables)  # may change the plan
+        orders = self.orders
+        if self.cons.plan['closed_orbit']:
+            # e.g. sextupoles then also focus, which the columns ignore
+            orders = [None] * len(orders)
+        analytic = [k for k, o in enumerate(orders) if o is not None]
+        numeric = [k for k, o in enumerate(orders) if o is None]
+        upper = numpy.broadcast_to(variables.bounds[1], values.shape)
+        steps = []
+        points = [values]
+        for k in numeric:
+            h = self.step * max(1.0, abs(values[k]))
+            if values[k] + h > upper[k]:
+                h = -h  # step inwards from the upper bound
+            x = values.copy()
+            x[k] += h
+            steps.append(h)
+            points.append(x)
+        if numeric:
+            results = self._evaluate(points, variables, kwargs)
+            f0 = results[0]
+            n_rows = len(f0)
+        else:
+            n_rows = self.cons.n_residuals
+        jac = numpy.zeros((n_rows, len(values)))
+        if analytic:
+            self._analytic_columns(jac, analytic, variables)
+        for k, h, f1 in zip(numeric, steps, results[1:] if numeric else []):
+            self.n_fd_columns += 1
+            jac[:, k] = (f1 - f0) / h
+        if numeric and (self._pool is None):
+            self.cons.make_changes(values, variables)  # restore the lattice
+        self.cons.stats.record('jacobian', time.perf_counter() - start)
+        return jac
+
+    def _evaluate(self, points, variables, kwargs):
+        """Evaluate the merit function at each of the points, either in this
+        process or, if processes is greater than 1, in the worker pool.
+        """
+        if self.processes > 1:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.processes, initializer=_init_worker,
+                    initargs=(self.cons, variables, kwargs)
+                )
+            self.n_remote += len(points)
+            return self._pool.map(_worker_merit, points)
+        return [numpy.asarray(self.cons.merit_function(x, variables, **kwargs),
+                              dtype=float) for x in points]
+
+    def close(self):
+        """Shut down the worker pool, if one was started.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _element_optics(self, element, entrance, exit):
+        """Average the linear optics through an element, starting from the
+        optics at its entrance, and return its integrated beta functions,
+        dispersion terms and mean phase advances as a dictionary.
+        """
+        length = element.Length
+        pb = element.PolynomB
+        k = pb[1] if len(pb) > 1 else 0.0
+        if length > 0:
+            h = getattr(element, 'BendingAngle', 0.0) / length
+            s = numpy.linspace(0, length, 5)
+            w = numpy.array([1, 4, 2, 4, 1]) * length / 12.0  # Simpson's rule
+        else:  # thin element, PolynomB is already integrated
+            h = 0.0
+            s = numpy.zeros(1)
+            w = numpy.ones(1)
+        betas = []
+        for plane, kp in enumerate([k + h**2, -k]):
+            b0 = entrance.beta[plane]
+            a0 = entrance.alpha[plane]
+            C, S = _focusing_functions(kp, s)
+            g0 = (1 + a0**2) / b0
+            betas.append(b0 * C**2 - 2 * a0 * C * S + g0 * S**2)
+        C, S = _focusing_functions(k + h**2, s)
+        if k + h**2 != 0:
+            D = h * (1 - C) / (k + h**2)
+        else:
+            D = h * s**2 / 2
+        eta = C * entrance.dispersion[0] + S * entrance.dispersion[1] + D
+        return {'beta': [numpy.sum(w * betas[0]), numpy.sum(w * betas[1])],
+                'sqrt_beta_eta': numpy.sum(w * numpy.sqrt(betas[0]) * eta),
+                'beta_eta': [numpy.sum(w * betas[0] * eta),
+                             numpy.sum(w * betas[1] * eta)],
+                'mu': (entrance.mu + exit.mu) / 2.0}
+
+    def _analytic_columns(self, jac, columns, variables):
+        """Fill the given columns of jac from one linopt pass, which includes
+        the variable elements as refpts.
+        """
+        ring = self.cons.cell  # identical superperiods change alike
+        elements = [[int(e) for e in self.cons.resolve(variables.indices[k])
+                     if e < len(ring)] for k in columns]
+        refpts = set(self.cons.refpts)
+        for elems in elements:
+            refpts.update(elems)
+            refpts.update([e + 1 for e in elems])
+        refpts.add(len(ring))
+        refpts = sorted(refpts)
+        position = {ref: n for n, ref in enumerate(refpts)}
+        lindata = self.cons.calc_lindata(refpts, get_chrom=False)[3]
+        mu_total = lindata.mu[-1]  # total phase advance of the cell
+        for k, elems in zip(columns, elements):
+            order = self.orders[k]
+            for elem in elems:  # a family's derivatives are summed
+                optics = self._element_optics(ring[elem],
+                                              lindata[position[elem]],
+                                              lindata[position[elem + 1]])
+                for entry in self.cons.layout:
+                    key = entry['key']
+                    refs = self.cons.desired_constraints[key][0]
+                    if order == 1:
+                        d = self._quadrupole_derivative(key, refs, optics,
+                                                        lindata, position,
+                                                        mu_total)
+                    else:
+                        d = self._sextupole_derivative(
+                            key, entry['stop'] - entry['start'], optics)
+                    if key in GLOBAL_FIELDS:
+                        d = d * self.cons.periodicity
+                    jac[entry['start']:entry['stop'], k] += (d *
+                                                             entry['weights'])
+
+    def _quadrupole_derivative(self, key, refs, optics, lindata, position,
+                               mu_total):
+        """Derivative of a field, at refs, with respect to the PolynomB[1]
+        of an element with the given optics.
+        """
+        plane = 1 if key.endswith('_y') else 0
+        sign = 1.0 if plane == 0 else -1.0  # focusing in x defocuses in y
+        g = sign * optics['beta'][plane]
+        phi_j = optics['mu'][plane]
+        mu = mu_total[plane]
+        if key in ['tune_x', 'tune_y']:
+            return numpy.array([g / (4 * numpy.pi)])
+        data = lindata[[position[ref] for ref in refs]]
+        tau = data.mu[:, plane] - phi_j
+        tau[tau < 0] += mu  # observation upstream of the perturbation
+        if key in ['eta_x', 'eta_px']:
+            g = optics['sqrt_beta_eta']
+            c = g / (2 * numpy.sin(mu / 2))
+            beta = data.beta[:, 0]
+            if key == 'eta_x':
+                return -c * numpy.sqrt(beta) * numpy.cos(tau - mu / 2)
+            return c * (data.alpha[:, 0] * numpy.cos(tau - mu / 2) +
+                        numpy.sin(tau - mu / 2)) / numpy.sqrt(beta)
+        a = g / (2 * numpy.sin(mu))
+        if key.startswith('beta'):
+            return -a * data.beta[:, plane] * numpy.cos(2 * tau - mu)
+        elif key.startswith('alpha'):
+            return -a * (data.alpha[:, plane] * numpy.cos(2 * tau - mu) +
+                         numpy.sin(2 * tau - mu))
+        else:  # phase advance
+            downstream = (data.mu[:, plane] > phi_j) * 2 * numpy.sin(mu)
+            return a / 2 * (numpy.sin(2 * tau - mu) +
+                            numpy.sin(2 * phi_j - mu) + downstream)
+
+    def _sextupole_derivative(self, key, n, optics):
+        """Derivative of a field, at its n refpts, with respect to the
+        PolynomB[2] of an element with the given optics; only the
+        chromaticity changes to first order on a zero closed orbit.
+        """
+        if key == 'chrom_x':
+            return numpy.array([optics['beta_eta'][0] / (2 * numpy.pi)])
+        elif key == 'chrom_y':
+            return numpy.array([-optics['beta_eta'][1] / (2 * numpy.pi)])
+        return numpy.zeros(n)
 
 
 class Optimizer(object):
@@ -159,23 +882,614 @@ class Optimizer(object):
         # create variables and constraints objects
         self.cons = c
         self.vars = v
+        self.cons.check_orbit_sources(v)  # so the plan is known up front
         print("Number of variables: {0}\nNumber of constraints: {1}"
               .format(len(self.vars.initial_values),
                       len(list(self.cons.desired_constraints.values())[0])))
 
     def run(self, return_values=False, max_iters=None, verbosity=0, ftol=1e-8,
-            xtol=1e-8, gtol=1e-8, **kwargs):
+            xtol=1e-8, gtol=1e-8, jac='2-point', processes=None, monitor=None,
+            profile=0, checkpoint=None, checkpoint_interval=60.0, x0=None,
+            **kwargs):
+        """jac may be any value accepted by least_squares, e.g. '2-point',
+        'analytic' to use a Jacobian provider, or 'parallel' to calculate
+        every column by finite differences in a pool of worker processes.
+        processes sets the number of workers used for the finite difference
+        columns of the 'analytic' and 'parallel' modes; for 'parallel' it
+        defaults to the number of CPUs. The number of function evaluations
+        (nfev), Jacobian evaluations (njev), linopt calls (n_linopt), and the
+        wall time in seconds are recorded on the optimizer after each run, so
+        that the different modes may be compared. monitor may wrap the merit
+        function, see run_async.
+        The stage timings of the run are kept in stats, an EvaluationStats
+        object, and printed if verbosity is greater than 0; if profile is
+        greater than 0 the cProfile profiles of that many of the slowest
+        evaluations are kept too. Evaluations in worker processes are not
+        included.
+        If checkpoint is a file path, the best values found so far, their
+        residuals, and the last Jacobian are saved to it atomically at most
+        every checkpoint_interval seconds and at the end of the run, see
+        Checkpoint and resume. x0 overrides the initial values as the start.
+        """
         # add return type option (lattice) or list of variable values
-        ls = least_squares(self.cons.merit_function, self.vars.initial_values,
-                           bounds=self.vars.bounds, ftol=ftol, xtol=xtol,
-                           gtol=gtol, max_nfev=max_iters, verbose=verbosity,
-                           args=([self.vars]), kwargs=kwargs)
         if verbosity > 0:
-            data = self.cons.convert_lindata(self.cons.calc_lindata())
+            print("Optics plan: {0} by {1} at {2} refpts, periodicity {3}"
+                  .format(', '.join(self.cons.plan['stages']),
+                          self.cons.plan['engine'],
+                          self.cons.plan['n_refpts'],
+                          self.cons.plan['periodicity']))
+        if x0 is None:
+            x0 = self.vars.initial_values
+        jac_monitor = None
+        if checkpoint is not None:
+            if not isinstance(checkpoint, Checkpoint):
+                checkpoint = Checkpoint(checkpoint, checkpoint_interval)
+            self.checkpoint = checkpoint
+            if monitor is None:
+                monitor = checkpoint.monitor
+            else:
+                inner = monitor
+                monitor = lambda f: checkpoint.monitor(inner(f))
+            jac_monitor = checkpoint.monitor_jacobian
+        n_linopt = self.cons.n_linopt
+        self.stats = self.cons.stats = EvaluationStats(profile)
+        start = time.time()
+        try:
+            ls, jac = _local_solve(self.cons, self.vars, x0, jac=jac,
+                                   processes=processes, max_iters=max_iters,
+                                   verbosity=verbosity, ftol=ftol, xtol=xtol,
+                                   gtol=gtol, kwargs=kwargs, monitor=monitor,
+                                   jac_monitor=jac_monitor)
+        finally:
+            if checkpoint is not None:
+                checkpoint.save()
+        self.wall_time = time.time() - start
+        self.nfev = ls.nfev
+        self.njev = ls.njev
+        self.n_linopt = self.cons.n_linopt - n_linopt
+        if isinstance(jac, Jacobian):
+            self.n_linopt += jac.n_remote
+        self.result = ls
+        # leave the lattice at the solution, free if it is still cached
+        lindata, _ = self.cons.evaluate(ls.x, self.vars, **kwargs)
+        if verbosity > 0:
+            print("Function evaluations: {0}, Jacobian evaluations: {1}, "
+                  "linopt calls: {2}, wall time: {3:.3f}s"
+                  .format(self.nfev, self.njev, self.n_linopt,
+                          self.wall_time))
+            print(self.stats.report())
+            if self.cons.cache_size > 0:
+                print("Cache hits: {0}, misses: {1}"
+                      .format(self.cons.cache_hits, self.cons.cache_misses))
+            data = {}
+            if lindata is not None:
+                data = self.cons.convert_lindata(lindata)
             for con, val in self.cons.desired_constraints.items():
-                print("Constraint '{0}', goal: {1}, result {2}"
-                      .format(con, val[1], data[con]))
+                if con in data:
+                    print("Constraint '{0}', goal: {1}, result {2}"
+                          .format(con, val[1], data[con]))
         if return_values is True:
             return ls.x
         else:
             return self.cons.lattice
+
+    def parameter_store(self):
+        """Return a ParameterStore of the element parameters the variables
+        change, e.g. to push the lattice's state before a run and roll back
+        to it afterwards instead of deepcopying the lattice.
+        """
+        return ParameterStore.from_variables(self.cons, self.vars)
+
+    def resume(self, path, reuse_jacobian=True, **kwargs):
+        """Warm-start run from the best values saved in the checkpoint at
+        path, carrying on checkpointing to it. The saved residuals answer
+        the first evaluation, and if reuse_jacobian is True the saved
+        Jacobian answers the first Jacobian evaluation if it was found at the
+        same values, so the restart costs no extra evaluations. N.B.
+        least_squares' trust region radius is not accessible, so it starts
+        again from its default.
+        """
+        checkpoint = Checkpoint.load(path, reuse_jacobian=reuse_jacobian)
+        if len(checkpoint.best_values) != len(self.vars.initial_values):
+            raise IndexError("The checkpoint at {0} has {1} variables, not "
+                             "{2}.".format(path, len(checkpoint.best_values),
+                                           len(self.vars.initial_values)))
+        kwargs.setdefault('checkpoint_interval', checkpoint.interval)
+        return self.run(checkpoint=checkpoint, x0=checkpoint.best_values,
+                        **kwargs)
+
+    def run_async(self, callback=None, interval=0.1, **kwargs):
+        """Start run, with the given keyword arguments, in a background thread
+        and return a RunHandle straight away. If given, callback is called
+        with a progress dictionary at most once every interval seconds, and
+        once more when the run finishes; it is called from the worker thread,
+        so GUI clients should only emit a signal from it.
+        N.B. the lattice must not be changed while the run is in progress.
+        """
+        return RunHandle(self, callback, interval, kwargs)
+
+    def _finite_bounds(self):
+        """Return the variables' (lower, upper) bounds as arrays, raising a
+        ValueError unless they are all finite.
+        """
+        n_vars = len(self.vars.initial_values)
+        lower = numpy.broadcast_to(self.vars.bounds[0], (n_vars,))
+        upper = numpy.broadcast_to(self.vars.bounds[1], (n_vars,))
+        if not (numpy.all(numpy.isfinite(lower)) and
+                numpy.all(numpy.isfinite(upper))):
+            raise ValueError("Global searches need every variable to have "
+                             "finite lower and upper bounds.")
+        return lower, upper
+
+    def start_points(self, n_starts, sampling='lhs', seed=None):
+        """Generate n_starts starting vectors inside the variables' bounds by
+        Latin hypercube ('lhs') or scrambled Sobol ('sobol') sampling.
+        """
+        n_vars = len(self.vars.initial_values)
+        lower, upper = self._finite_bounds()
+        if sampling == 'lhs':
+            sampler = qmc.LatinHypercube(n_vars, rng=seed)
+        elif sampling == 'sobol':
+            sampler = qmc.Sobol(n_vars, rng=seed)
+        else:
+            raise ValueError("Unknown sampling method {0}, use 'lhs' or "
+                             "'sobol'.".format(sampling))
+        return qmc.scale(sampler.random(n_starts), lower, upper)
+
+    def multi_start(self, n_starts, sampling='lhs', processes=None, seed=None,
+                    stop_cost=None, include_initial=True, return_values=False,
+                    max_iters=None, ftol=1e-8, xtol=1e-8, gtol=1e-8,
+                    jac='2-point', **kwargs):
+        """Run local solves from n_starts starting vectors, sampled inside the
+        variables' bounds (see start_points), plus the variables' initial
+        values if include_initial is True, and return all their results, as
+        dictionaries, ranked by cost (lowest first). The solves are run in a
+        pool of processes worker processes, by default one per CPU, each
+        with its own copy of the lattice; if processes is 1 they are run one
+        after another in this process. If stop_cost is given the remaining
+        solves are abandoned as soon as one finishes with a cost at or below
+        it. The lattice is left at, and the results are stored in results
+        with, the best solution found.
+        """
+        points = list(self.start_points(n_starts, sampling, seed))
+        if include_initial:
+            points.insert(0, numpy.array(self.vars.initial_values,
+                                         dtype=float))
+        options = {'jac': 'analytic' if jac == 'analytic' else '2-point',
+                   'max_iters': max_iters, 'ftol': ftol, 'xtol': xtol,
+                   'gtol': gtol}
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        start = time.time()
+        results = []
+        if processes > 1:
+            pool = multiprocessing.Pool(
+                processes, initializer=_init_worker,
+                initargs=(self.cons, self.vars, kwargs)
+            )
+            try:
+                for result in pool.imap_unordered(_worker_start,
+                                                  [(x0, options)
+                                                   for x0 in points]):
+                    results.append(result)
+                    if (stop_cost is not None) and (result['cost'] <=
+                                                    stop_cost):
+                        break
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for x0 in points:
+                results.append(_start_result(self.cons, self.vars, x0, options,
+                                             kwargs))
+                if (stop_cost is not None) and (results[-1]['cost'] <=
+                                                stop_cost):
+                    break
+        self.wall_time = time.time() - start
+        results.sort(key=lambda result: result['cost'])
+        self.results = results
+        self.cons.evaluate(results[0]['x'], self.vars, **kwargs)
+        if return_values is True:
+            return results[0]['x']
+        else:
+            return results
+
+    def run_global(self, population=15, generations=100, processes=None,
+                   seed=None, tol=0.01, polish=True, return_values=False,
+                   verbosity=0, max_iters=None, ftol=1e-8, xtol=1e-8,
+                   gtol=1e-8, jac='2-point', **kwargs):
+        """Search the whole of the variables' bounds, which must be finite,
+        by differential evolution on the cost, half the sum of the squared
+        residuals, for up to generations generations of population times the
+        number of variables members; the initial values are one member.
+        Each generation is evaluated as one batch in a pool of processes
+        worker processes, by default one per CPU, each with its own copy of
+        the lattice, or in this process if processes is 1. Unstable members
+        are given an infinite cost. If polish is True the best member is
+        then refined by least_squares, with the same options as run. The
+        evolution's result is stored in global_result, and the lattice is left
+        at the best solution.
+        """
+        lower, upper = self._finite_bounds()
+        x0 = numpy.clip(self.vars.initial_values, lower, upper)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        start = time.time()
+        pool = None
+        if processes > 1:
+            pool = multiprocessing.Pool(
+                processes, initializer=_init_worker,
+                initargs=(self.cons, self.vars, kwargs)
+            )
+
+            def workers(func, members):  # evaluate a generation as a batch
+                return pool.map(_worker_cost, members)
+        else:
+            workers = 1
+        try:
+            de = differential_evolution(
+                _cost, list(zip(lower, upper)),
+                args=(self.cons, self.vars, kwargs) if pool is None else (),
+                popsize=population, maxiter=generations, tol=tol, rng=seed,
+                x0=x0, polish=False, updating='deferred', workers=workers,
+                disp=verbosity > 0
+            )
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        self.global_result = de
+        self.nfev = de.nfev
+        x = de.x
+        if polish and numpy.isfinite(de.fun):
+            ls, _ = _local_solve(self.cons, self.vars, de.x, jac=jac,
+                                 max_iters=max_iters, verbosity=verbosity,
+                                 ftol=ftol, xtol=xtol, gtol=gtol,
+                                 kwargs=kwargs)
+            self.result = ls
+            self.nfev += ls.nfev
+            if ls.cost <= de.fun:
+                x = ls.x
+        self.wall_time = time.time() - start
+        self.cons.evaluate(x, self.vars, **kwargs)
+        if verbosity > 0:
+            print("Global search: cost {0:.6g} after {1} generations, "
+                  "{2} function evaluations, wall time: {3:.3f}s"
+                  .format(de.fun, de.nit, self.nfev, self.wall_time))
+        if return_values is True:
+            return x
+        else:
+            return self.cons.lattice
+
+    def _response_key(self):
+        """Return a key for the response matrix at the lattice's current
+        state for these variables and constraints.
+        """
+        parts = [lattice_digest(self.cons.lattice), self.cons.plan['engine']]
+        for field, index in zip(self.vars.fields, self.vars.indices):
+            parts.append((_definition_name(field), repr(index)))
+        for key, (refpts, desired, weights) in \
+                self.cons.desired_constraints.items():
+            parts.append((_definition_name(key), list(refpts),
+                          numpy.shape(desired), list(weights)))
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def response_matrix(self, values=None, cache_dir=None, **kwargs):
+        """Return the response matrix, the Jacobian of the residuals, at the
+        values (by default the initial values), and whether it was loaded
+        from the cache. If cache_dir is given the matrix is loaded from, or
+        saved to, a file there keyed by the lattice's element parameters and
+        the definitions of the variables and constraints.
+        """
+        if values is None:
+            values = self.vars.initial_values
+        values = numpy.array(values, dtype=float)
+        self.cons.make_changes(values, self.vars)
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir,
+                                'response_{0}.npy'.format(self._response_key()))
+            if os.path.exists(path):
+                return numpy.load(path), True
+        jac = Jacobian(self.cons, self.vars)
+        try:
+            matrix = jac(values, self.vars, **kwargs)
+        finally:
+            jac.close()
+        if path is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(path + '.tmp', 'wb') as f:
+                numpy.save(f, matrix)
+            os.replace(path + '.tmp', path)  # never leave a partial file
+        return matrix, False
+
+    def run_linear(self, max_iters=10, alpha=1e-3, tol=1e-20, broyden=True,
+                   cache_dir=None, return_values=False, verbosity=0,
+                   **kwargs):
+        """Match by treating the residuals as linear in the variables: the
+        response matrix is found once (see response_matrix, which can cache
+        it on disk) and each step solves it by SVD with Tikhonov
+        regularisation, alpha times the largest singular value. After a step
+        the matrix is corrected by a Broyden rank one update rather than
+        recalculated, unless broyden is False. A step that doesn't reduce the
+        cost is rejected and retried with ten times the regularisation. The
+        solve stops when the cost is at or below tol, after max_iters steps,
+        or when a step no longer changes the values. For a nearly linear
+        match with a cached matrix this needs only a couple of linopt calls.
+        The result is stored in result, and the lattice is left at the best
+        values found.
+        """
+        lower = numpy.broadcast_to(self.vars.bounds[0],
+                                   (len(self.vars.initial_values),))
+        upper = numpy.broadcast_to(self.vars.bounds[1], lower.shape)
+        n_linopt = self.cons.n_linopt
+        start = time.time()
+        x = numpy.clip(numpy.array(self.vars.initial_values, dtype=float),
+                       lower, upper)
+        matrix, self.response_cached = self.response_matrix(x, cache_dir,
+                                                            **kwargs)
+        residuals = self.cons.merit_function(x, self.vars, **kwargs)
+        cost = 0.5 * numpy.dot(residuals, residuals)
+        nfev = 1
+        message = "Maximum number of iterations reached."
+        for _ in range(max_iters):
+            if cost <= tol:
+                message = "Cost is at or below tol."
+                break
+            u, s, vt = numpy.linalg.svd(matrix, full_matrices=False)
+            damping = (alpha * s[0])**2
+            step = -numpy.dot(vt.T, (s / (s**2 + damping)) *
+                              numpy.dot(u.T, residuals))
+            x_new = numpy.clip(x + step, lower, upper)
+            step = x_new - x
+            if not numpy.any(step):
+                message = "The step no longer changes the values."
+                break
+            try:
+                r_new = self.cons.merit_function(x_new, self.vars, **kwargs)
+                cost_new = 0.5 * numpy.dot(r_new, r_new)
+            except ValueError:
+                r_new, cost_new = None, numpy.inf
+            nfev += 1
+            if numpy.isfinite(cost_new) and broyden:
+                matrix = matrix + numpy.outer(r_new - residuals -
+                                              numpy.dot(matrix, step),
+                                              step) / numpy.dot(step, step)
+            if cost_new < cost:
+                x, residuals, cost = x_new, r_new, cost_new
+            else:
+                alpha *= 10.0
+        self.response = matrix
+        self.wall_time = time.time() - start
+        self.nfev = nfev
+        self.n_linopt = self.cons.n_linopt - n_linopt
+        self.result = OptimizeResult(x=x, cost=cost, fun=residuals,
+                                     nfev=nfev, nit=nfev - 1,
+                                     success=cost <= tol, message=message)
+        self.cons.make_changes(x, self.vars)
+        if verbosity > 0:
+            print("Linear match: cost {0:.6g}, response matrix {1}, function "
+                  "evaluations: {2}, linopt calls: {3}, wall time: {4:.3f}s"
+                  .format(cost, 'cached' if self.response_cached else
+                          'calculated', nfev, self.n_linopt, self.wall_time))
+        if return_values is True:
+            return x
+        else:
+            return self.cons.lattice
+
+
+class Checkpoint(object):
+    """The progress of a run, saved to a .npz file so that it can be resumed
+    after the process dies, see Optimizer.run and Optimizer.resume.
+    The merit function and Jacobian provider are wrapped to record the best
+    values evaluated, which least_squares' iterate never moves away from,
+    their residuals, and the last Jacobian and the values it was found at.
+    The file is written to a temporary file and then renamed over the
+    checkpoint, so it is never left partly written.
+    """
+    def __init__(self, path, interval=60.0):
+        self.path = path
+        self.interval = interval
+        self.best_values = None
+        self.best_cost = numpy.inf
+        self.best_residuals = None
+        self.jac_values = None
+        self.jacobian = None
+        self.nfev = 0
+        self.njev = 0
+        self._warm = {}  # saved results to answer the first calls with
+        self._last_save = time.time()
+
+    @classmethod
+    def load(cls, path, reuse_jacobian=True):
+        """Return a Checkpoint holding the state saved at path, ready to
+        warm-start a run.
+        """
+        with numpy.load(path) as data:
+            checkpoint = cls(path, float(data['interval']))
+            checkpoint.best_values = data['best_values']
+            checkpoint.best_cost = float(data['best_cost'])
+            checkpoint.best_residuals = data['best_residuals']
+            checkpoint.nfev = int(data['nfev'])
+            checkpoint.njev = int(data['njev'])
+            if data['jacobian'].size > 0:
+                checkpoint.jac_values = data['jac_values']
+                checkpoint.jacobian = data['jacobian']
+        checkpoint._warm['fun'] = (checkpoint.best_values,
+                                   checkpoint.best_residuals)
+        if reuse_jacobian and checkpoint.jacobian is not None:
+            checkpoint._warm['jac'] = (checkpoint.jac_values,
+                                       checkpoint.jacobian)
+        return checkpoint
+
+    def _warm_result(self, kind, values):
+        """Return the saved result for the first call of kind if it was at
+        the same values, otherwise None.
+        """
+        saved = self._warm.pop(kind, None)
+        if (saved is not None) and numpy.array_equal(saved[0], values):
+            return saved[1].copy()
+        return None
+
+    def monitor(self, merit_function):
+        """Wrap the merit function to record the best values evaluated.
+        """
+        def monitored(values, variables, **kwargs):
+            residuals = self._warm_result('fun', values)
+            if residuals is None:
+                residuals = merit_function(values, variables, **kwargs)
+                self.nfev += 1
+            cost = 0.5 * numpy.dot(residuals, residuals)
+            if cost < self.best_cost:
+                self.best_cost = cost
+                self.best_values = numpy.array(values, dtype=float)
+                self.best_residuals = numpy.array(residuals, dtype=float)
+            self._maybe_save()
+            return residuals
+        return monitored
+
+    def monitor_jacobian(self, jacobian):
+        """Wrap the Jacobian provider to record the last Jacobian.
+        """
+        def monitored(values, variables, **kwargs):
+            jac = self._warm_result('jac', values)
+            if jac is None:
+                jac = jacobian(values, variables, **kwargs)
+                self.njev += 1
+            self.jac_values = numpy.array(values, dtype=float)
+            self.jacobian = numpy.array(jac, dtype=float)
+            self._maybe_save()
+            return jac
+        return monitored
+
+    def _maybe_save(self):
+        if time.time() - self._last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        """Write the checkpoint to its path atomically.
+        """
+        self._last_save = time.time()
+        if self.best_values is None:
+            return
+        empty = numpy.zeros(0)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            numpy.savez(f, best_values=self.best_values,
+                        best_cost=self.best_cost,
+                        best_residuals=self.best_residuals,
+                        jac_values=(empty if self.jac_values is None
+                                    else self.jac_values),
+                        jacobian=(empty if self.jacobian is None
+                                  else self.jacobian),
+                        nfev=self.nfev, njev=self.njev,
+                        interval=self.interval, time=self._last_save)
+        os.replace(temporary, self.path)
+
+
+class _Cancelled(Exception):
+    """Raised inside the merit function to stop a cancelled run.
+    """
+    pass
+
+
+class RunHandle(object):
+    """Handle to an optimisation running in a background thread, as returned
+    by Optimizer.run_async.
+    Every merit evaluation puts a progress dictionary, with the keys 'nfev',
+    'cost', 'values', 'best_cost', 'best_values' and 'done', on the updates
+    queue; the last one put has 'done' set to True.
+    """
+    def __init__(self, optimizer, callback, interval, kwargs):
+        self.optimizer = optimizer
+        self.callback = callback
+        self.interval = interval
+        self.updates = queue.Queue()
+        self.latest = None
+        self.nfev = 0
+        self.best_values = None
+        self.best_cost = numpy.inf
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self._cancel = threading.Event()
+        self._last_callback = 0.0
+        self._thread = threading.Thread(target=self._run, args=(kwargs,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, kwargs):
+        kwargs['return_values'] = True
+        try:
+            self.optimizer.run(monitor=self._monitor, **kwargs)
+            self.result = self.optimizer.result
+        except _Cancelled:
+            self.cancelled = True
+            if self.best_values is not None:  # leave the lattice at the best
+                self.optimizer.cons.make_changes(self.best_values,
+                                                 self.optimizer.vars)
+        except Exception as error:
+            self.error = error
+        finally:
+            self._report(self.latest or {}, done=True)
+
+    def _monitor(self, merit_function):
+        """Wrap the merit function to record the progress of the run and to
+        stop it once cancel has been called.
+        """
+        def monitored(values, variables, **kwargs):
+            if self._cancel.is_set():
+                raise _Cancelled()
+            residuals = merit_function(values, variables, **kwargs)
+            cost = 0.5 * numpy.dot(residuals, residuals)
+            self.nfev += 1
+            if cost < self.best_cost:
+                self.best_cost = cost
+                self.best_values = numpy.array(values, dtype=float)
+            self._report({'cost': cost,
+                          'values': numpy.array(values, dtype=float)})
+            return residuals
+        return monitored
+
+    def _report(self, progress, done=False):
+        progress = dict(progress, nfev=self.nfev, best_cost=self.best_cost,
+                        best_values=self.best_values, done=done)
+        self.latest = progress
+        self.updates.put(progress)
+        now = time.time()
+        if (self.callback is not None) and \
+                (done or (now - self._last_callback >= self.interval)):
+            self._last_callback = now
+            self.callback(progress)
+
+    def cancel(self):
+        """Ask the run to stop at its next merit evaluation; the lattice is
+        then left at the best values found so far.
+        """
+        self._cancel.set()
+
+    def done(self):
+        """Return True if the run has finished, been cancelled or failed.
+        """
+        return not self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        """Wait for the run to finish and return the best values found, or
+        None if it is still running after timeout seconds. If the run failed
+        its exception is raised.
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.best()[0]
+
+    def best(self):
+        """Return the best (values, cost) found so far; this is the solution
+        once a run has finished normally.
+        """
+        if self.result is not None:
+            return self.result.x, self.result.cost
+        return self.best_values, self.best_cost
@@ -0,0 +1,92 @@
+import numpy
+
+CQ = 3.8319e-13  # quantum excitation constant for electrons, m
+ELECTRON_MASS = 0.51099895e6  # eV
+CGAMMA = 8.846056192e-32  # radiation constant for electrons, m / eV**3
+SPEED_OF_LIGHT = 299792458.0  # m / s
+
+
+def dipole_indices(lattice):
+    """Return the indices of every element of the lattice that bends.
+    """
+    return [index for index, elem in enumerate(lattice)
+            if getattr(elem, 'BendingAngle', 0.0) != 0.0]
+
+
+def radiation_integrals(lattice, dipoles, entrance, n_slices=9):
+    """Return the synchrotron radiation integrals I1 to I5 as an array.
+
+    Only dipoles contribute, so the horizontal optics are propagated through
+    each of them, with its gradient and edge angles, from the optics at its
+    entrance; entrance is a lindata recarray with a row for each of the
+    dipoles, as given by linopt with them as refpts. The integrals through
+    every dipole are then found at once by Simpson's rule over n_slices
+    (odd) points.
+    """
+    length = numpy.array([lattice[i].Length for i in dipoles])
+    h = numpy.array([lattice[i].BendingAngle for i in dipoles]) / length
+    k = numpy.array([lattice[i].PolynomB[1] if len(lattice[i].PolynomB) > 1
+                     else 0.0 for i in dipoles])
+    edge1 = h * numpy.tan([getattr(lattice[i], 'EntranceAngle', 0.0)
+                           for i in dipoles])
+    edge2 = h * numpy.tan([getattr(lattice[i], 'ExitAngle', 0.0)
+                           for i in dipoles])
+    kx = (k + h**2)[:, None]
+    # optics just inside the entrance edge
+    beta0 = entrance.beta[:, 0][:, None]
+    alpha0 = (entrance.alpha[:, 0] - entrance.beta[:, 0] * edge1)[:, None]
+    gamma0 = (1 + alpha0**2) / beta0
+    eta0 = entrance.dispersion[:, 0][:, None]
+    etap0 = (entrance.dispersion[:, 1] +
+             entrance.dispersion[:, 0] * edge1)[:, None]
+    s = length[:, None] * numpy.linspace(0, 1, n_slices)
+    rk = numpy.sqrt(numpy.abs(kx))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        C = numpy.where(kx > 0, numpy.cos(rk * s),
+                        numpy.where(kx < 0, numpy.cosh(rk * s), 1.0))
+        S = numpy.where(kx > 0, numpy.sin(rk * s) / rk,
+                        numpy.where(kx < 0, numpy.sinh(rk * s) / rk, s))
+        D = numpy.where(kx != 0, h[:, None] * (1 - C) / kx,
+                        h[:, None] * s**2 / 2)
+    Cp = -kx * S
+    eta = C * eta0 + S * etap0 + D
+    etap = Cp * eta0 + C * etap0 + h[:, None] * S
+    beta = C**2 * beta0 - 2 * C * S * alpha0 + S**2 * gamma0
+    alpha = -C * Cp * beta0 + (C**2 + S * Cp) * alpha0 - S * C * gamma0
+    curly_h = ((1 + alpha**2) * eta**2 / beta + 2 * alpha * eta * etap +
+               beta * etap**2)
+    weights = numpy.ones(n_slices)
+    weights[1:-1:2] = 4
+    weights[2:-1:2] = 2
+    weights = weights * length[:, None] / (3.0 * (n_slices - 1))
+    eta_integral = numpy.sum(weights * eta, axis=1)
+    i1 = numpy.sum(eta_integral * h)
+    i2 = numpy.sum(length * h**2)
+    i3 = numpy.sum(length * numpy.abs(h)**3)
+    i4 = numpy.sum(eta_integral * h * (h**2 + 2 * k) -
+                   (eta[:, 0] * edge1 + eta[:, -1] * edge2) * h)
+    i5 = numpy.sum(numpy.sum(weights * curly_h, axis=1) * numpy.abs(h)**3)
+    return numpy.array([i1, i2, i3, i4, i5])
+
+
+def radiation_parameters(integrals, energy, circumference):
+    """Return the equilibrium parameters given by the radiation integrals,
+    for electrons of the given energy in eV, as a dictionary of
+    'emittance' (m rad), 'energy_spread', 'momentum_compaction', the
+    horizontal and longitudinal damping partition numbers 'partition_x' and
+    'partition_e', the 'energy_loss' per turn (eV) and the horizontal,
+    vertical and longitudinal 'damping_times' (s).
+    """
+    i1, i2, i3, i4, i5 = integrals
+    gamma = energy / ELECTRON_MASS
+    partitions = numpy.array([1 - i4 / i2, 1.0, 2 + i4 / i2])
+    energy_loss = CGAMMA * i2 * energy**4 / (2 * numpy.pi)
+    revolution_time = circumference / SPEED_OF_LIGHT
+    return {'emittance': CQ * gamma**2 * i5 / (i2 - i4),
+            'energy_spread': numpy.sqrt(CQ * gamma**2 * i3 / (2 * i2 + i4)),
+            'momentum_compaction': i1 / circumference,
+            'partition_x': partitions[0],
+            'partition_e': partitions[2],
+            'energy_loss': energy_loss,
+            'damping_times': (2 * energy * revolution_time /
+                              (energy_loss * partitions))}
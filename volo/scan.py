@@ -0,0 +1,196 @@
+import multiprocessing
+import os
+import time
+
+import numpy
+from numpy.lib.format import open_memmap
+
+_worker = {}
+
+
+def _init_worker(scan):
+    """Keep a copy of the scan, and therefore the lattice, resident in a pool
+    worker process.
+    """
+    _worker['scan'] = scan
+
+
+def _worker_chunk(indices):
+    return indices, _worker['scan'].evaluate_chunk(indices)
+
+
+class Scan(object):
+    """Evaluate optics quantities at many points in variable space, e.g. a
+    tune diagram over a grid of two quadrupole families' strengths.
+
+    The results are streamed, as they arrive, into a memory-mapped .npy file
+    with a row per point and a column per value, so a scan never needs all
+    of its results in memory. A second file alongside it (path with .npy
+    replaced by .done.npy) records which points are finished, so that an
+    interrupted scan resumes where it stopped when it is run again.
+    """
+    def __init__(self, constraints, variables, path, points=None, axes=None,
+                 fields=None, **kwargs):
+        """Either points, an (n_points, n_variables) array (which may itself
+        be memory-mapped), or axes, a list of one 1-D array of values per
+        variable to scan every combination of, must be given; the grid points
+        are generated as they are needed, the last axis varying fastest.
+        fields are the constraint fields to record, by default every
+        non-callable field of the constraints, plus 'cost' for half the sum
+        of the squared residuals; each takes as many columns as it has
+        values, and the names of the columns are kept in columns. kwargs are
+        passed on to the merit function. Points at which the lattice is
+        unstable are recorded as NaN.
+        """
+        if (points is None) == (axes is None):
+            raise ValueError("Exactly one of points and axes must be given.")
+        n_vars = len(variables.initial_values)
+        if points is not None:
+            if numpy.ndim(points) != 2 or numpy.shape(points)[1] != n_vars:
+                raise IndexError("Points must be an array of shape (n_points,"
+                                 " {0}).".format(n_vars))
+            self.n_points = len(points)
+            self.shape = (self.n_points,)
+        else:
+            if len(axes) != n_vars:
+                raise IndexError("One axis must be given per variable.")
+            axes = [numpy.asarray(axis, dtype=float) for axis in axes]
+            self.shape = tuple(len(axis) for axis in axes)
+            self.n_points = int(numpy.prod(self.shape))
+        self.cons = constraints
+        self.vars = variables
+        self.points = points
+        self.axes = axes
+        self.kwargs = kwargs
+        if not path.endswith('.npy'):
+            raise ValueError("The scan path must end with .npy.")
+        self.path = path
+        self.done_path = path[:-4] + '.done.npy'
+        entries = {entry['key']: entry for entry in constraints.layout
+                   if not callable(entry['key'])}
+        if fields is None:
+            fields = list(entries)
+        self.fields = fields
+        self.columns = []
+        for field in fields:
+            if field == 'cost':
+                self.columns.append('cost')
+            elif field not in entries:
+                raise KeyError("Field {0} is not one of the constraints' "
+                               "fields.".format(field))
+            else:
+                size = entries[field]['desired'].size
+                self.columns.extend(['{0}[{1}]'.format(field, n)
+                                     for n in range(size)] if size > 1
+                                    else [field])
+
+    def values_at(self, indices):
+        """Return the variable values of the points at the given indices.
+        """
+        if self.points is not None:
+            return numpy.asarray(self.points[indices], dtype=float)
+        position = numpy.unravel_index(indices, self.shape)
+        return numpy.stack([axis[p] for axis, p in zip(self.axes, position)],
+                           axis=1)
+
+    def evaluate_chunk(self, indices):
+        """Evaluate the points at the given indices, returning a row of
+        column values for each of them.
+        """
+        rows = numpy.full((len(indices), len(self.columns)), numpy.nan)
+        for row, values in zip(rows, self.values_at(indices)):
+            try:
+                lindata, residuals = self.cons.evaluate(values, self.vars,
+                                                        **self.kwargs)
+            except ValueError:
+                continue  # e.g. an unstable lattice, left as NaN
+            data = {}
+            if lindata is not None:
+                data = self.cons.convert_lindata(lindata)
+            row[:] = numpy.concatenate([
+                [0.5 * numpy.dot(residuals, residuals)] if field == 'cost'
+                else numpy.ravel(data[field]) for field in self.fields
+            ])
+        return rows
+
+    def open(self, mode='r'):
+        """Return the (results, done) memory maps; results has a row per
+        point, and done is True for each point that has been evaluated.
+        """
+        return (open_memmap(self.path, mode=mode),
+                open_memmap(self.done_path, mode=mode))
+
+    def _create(self):
+        """Open the output files for writing, creating them if they don't
+        exist; existing files must be from a scan of the same shape.
+        """
+        shape = (self.n_points, len(self.columns))
+        if os.path.exists(self.path) and os.path.exists(self.done_path):
+            results, done = self.open('r+')
+            if results.shape != shape or done.shape != (self.n_points,):
+                raise ValueError("The existing scan at {0} has shape {1}, "
+                                 "not {2}.".format(self.path, results.shape,
+                                                   shape))
+            return results, done
+        results = open_memmap(self.path, mode='w+', dtype=numpy.float64,
+                              shape=shape)
+        results[:] = numpy.nan
+        done = open_memmap(self.done_path, mode='w+', dtype=numpy.bool_,
+                           shape=(self.n_points,))
+        return results, done
+
+    @property
+    def n_done(self):
+        """The number of points that have been evaluated so far.
+        """
+        if not os.path.exists(self.done_path):
+            return 0
+        return int(numpy.count_nonzero(self.open()[1]))
+
+    def run(self, processes=None, chunk_size=1000, flush_interval=10.0,
+            callback=None):
+        """Evaluate every point not already done, in chunks of chunk_size
+        points, in a pool of processes worker processes, by default one per
+        CPU, each with its own copy of the lattice, or in this process if
+        processes is 1. Finished chunks are written as they arrive and the
+        files flushed at least every flush_interval seconds, so at most that
+        much work is lost if the scan is interrupted. If given, callback is
+        called with (n_done, n_points) after each chunk. The lattice is
+        restored to the variables' initial values afterwards.
+        """
+        results, done = self._create()
+        remaining = numpy.flatnonzero(~done)
+        chunks = [remaining[start:start + chunk_size]
+                  for start in range(0, len(remaining), chunk_size)]
+        n_done = self.n_points - len(remaining)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = None
+        if processes > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                        initargs=(self,))
+            finished = pool.imap_unordered(_worker_chunk, chunks)
+        else:
+            finished = ((indices, self.evaluate_chunk(indices))
+                        for indices in chunks)
+        last_flush = time.time()
+        try:
+            for indices, rows in finished:
+                results[indices] = rows
+                done[indices] = True
+                n_done += len(indices)
+                if time.time() - last_flush >= flush_interval:
+                    results.flush()  # results before done, never the reverse
+                    done.flush()
+                    last_flush = time.time()
+                if callback is not None:
+                    callback(n_done, self.n_points)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            results.flush()
+            done.flush()
+            if pool is None:
+                self.cons.make_changes(self.vars.initial_values, self.vars)
+        return results
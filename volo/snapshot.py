@@ -0,0 +1,95 @@
+import numpy
+
+
+class ParameterStore(object):
+    """Snapshots of a chosen set of element parameters of a lattice.
+
+    A state is just an array holding the value of each parameter, so taking,
+    comparing and applying one costs O(k) for k parameters, rather than a
+    deepcopy of the whole lattice. States can be kept and applied in any
+    order, or pushed onto and rolled back from the store's history.
+    """
+    def __init__(self, lattice, parameters, optics=None):
+        """parameters is a list of (index, field, cell) for each parameter,
+        where cell is None for a scalar field such as 'Length', or the cell of
+        an array field, e.g. (12, 'PolynomB', 1). If optics, an
+        IncrementalOptics engine for the lattice, or for its first
+        superperiod, is given, it is told about the elements that apply
+        changes.
+        """
+        self.lattice = lattice
+        self.parameters = [(int(index), field, cell)
+                           for index, field, cell in parameters]
+        self.optics = optics
+        self.history = []
+
+    @classmethod
+    def from_variables(cls, constraints, variables):
+        """Return a store of every element parameter that the variables
+        change, with family names resolved by the constraints, which must be
+        for the same lattice. Callable fields can change anything, so they
+        can't be included.
+        """
+        parameters = []
+        for field, index in zip(variables.fields, variables.indices):
+            if callable(field):
+                continue
+            if isinstance(field, str):
+                field, cell = field, None
+            else:
+                field, cell = field[0], field[1]
+            for i in constraints.resolve(index):
+                parameters.append((i, field, cell))
+        return cls(constraints.lattice, parameters, constraints.optics)
+
+    def snapshot(self):
+        """Return the current state of the parameters.
+        """
+        state = numpy.empty(len(self.parameters))
+        for n, (index, field, cell) in enumerate(self.parameters):
+            value = vars(self.lattice[index])[field]
+            state[n] = value if cell is None else value[cell]
+        return state
+
+    def diff(self, state, other=None):
+        """Return (index, field, cell, value, other_value) for each parameter
+        that differs between state and other, by default the current state.
+        """
+        if other is None:
+            other = self.snapshot()
+        return [self.parameters[n] + (state[n], other[n])
+                for n in numpy.flatnonzero(state != other)]
+
+    def apply(self, state):
+        """Set the parameters to a state, only writing those that differ from
+        the current state, and return the indices of the changed elements.
+        """
+        current = self.snapshot()
+        changed = []
+        for n in numpy.flatnonzero(current != state):
+            index, field, cell = self.parameters[n]
+            if cell is None:
+                vars(self.lattice[index])[field] = state[n]
+            else:
+                vars(self.lattice[index])[field][cell] = state[n]
+            changed.append(index)
+        if changed and (self.optics is not None):
+            # the engine may only hold the first superperiod of the lattice
+            self.optics.invalidate([index for index in changed
+                                    if index < len(self.optics.lattice)])
+        return changed
+
+    def push(self):
+        """Save the current state onto the history, and return it.
+        """
+        state = self.snapshot()
+        self.history.append(state)
+        return state
+
+    def rollback(self):
+        """Restore, and remove from the history, the last pushed state,
+        returning the indices of the changed elements.
+        """
+        if not self.history:
+            raise IndexError("There is no state to roll back to.")
+        return self.apply(self.history.pop())
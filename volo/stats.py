@@ -0,0 +1,115 @@
+import cProfile
+import heapq
+import io
+import pstats
+from bisect import bisect
+
+# Histogram bin edges in seconds, four per decade from 1us to 100s
+BIN_EDGES = [10 ** (exponent / 4.0) for exponent in range(-24, 9)]
+
+
+class EvaluationStats(object):
+    """Timings of the stages of merit function evaluation.
+
+    For each stage the number of calls, the total, minimum and maximum time,
+    and a histogram of the times over the logarithmic BIN_EDGES are kept;
+    recording a time is a few dictionary and list operations, so it is cheap
+    enough to leave on. If profile is greater than 0 every evaluation is run
+    under cProfile, which is not cheap, and the profiles of the profile
+    slowest evaluations are kept.
+    """
+    def __init__(self, profile=0):
+        self.profile = profile
+        self.reset()
+
+    def reset(self):
+        """Discard every recorded time and profile.
+        """
+        self.stages = {}
+        self._profiles = []  # heap of (time, sequence, pstats.Stats)
+        self._sequence = 0
+
+    def record(self, stage, duration):
+        """Add the duration in seconds of one call of stage.
+        """
+        try:
+            stats = self.stages[stage]
+        except KeyError:
+            stats = self.stages[stage] = {'count': 0, 'total': 0.0,
+                                          'min': duration, 'max': duration,
+                                          'histogram':
+                                              [0] * (len(BIN_EDGES) + 1)}
+        stats['count'] += 1
+        stats['total'] += duration
+        if duration < stats['min']:
+            stats['min'] = duration
+        elif duration > stats['max']:
+            stats['max'] = duration
+        stats['histogram'][bisect(BIN_EDGES, duration)] += 1
+
+    def start_profile(self):
+        """Return a running profiler for an evaluation, or None if profiling
+        is off.
+        """
+        if self.profile <= 0:
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop_profile(self, profiler, duration):
+        """Stop the profiler of an evaluation that took duration seconds and
+        keep its profile if it is one of the slowest.
+        """
+        if profiler is None:
+            return
+        profiler.disable()
+        self._sequence += 1
+        item = (duration, self._sequence, pstats.Stats(profiler))
+        if len(self._profiles) < self.profile:
+            heapq.heappush(self._profiles, item)
+        elif duration > self._profiles[0][0]:
+            heapq.heapreplace(self._profiles, item)
+
+    @property
+    def profiles(self):
+        """The (duration, pstats.Stats) of the slowest profiled evaluations,
+        slowest first.
+        """
+        return [(duration, stats) for duration, _, stats in
+                sorted(self._profiles, reverse=True)]
+
+    def summary(self):
+        """Return a dictionary of stage -> {'count', 'total', 'mean', 'min',
+        'max', 'histogram'}, where histogram holds the counts in the bins
+        below BIN_EDGES[0], between each pair of edges, and above the last.
+        """
+        summary = {}
+        for stage, stats in self.stages.items():
+            summary[stage] = dict(stats, histogram=list(stats['histogram']),
+                                  mean=stats['total'] / stats['count'])
+        return summary
+
+    def report(self, n_lines=10):
+        """Return a table of the stage timings, slowest total first, followed
+        by the top n_lines functions of each kept profile.
+        """
+        lines = ["{0:<14}{1:>8}{2:>12}{3:>12}{4:>12}{5:>12}".format(
+            'stage', 'calls', 'total (s)', 'mean (ms)', 'min (ms)',
+            'max (ms)')]
+        for stage, stats in sorted(self.stages.items(),
+                                   key=lambda item: -item[1]['total']):
+            lines.append("{0:<14}{1:>8}{2:>12.4f}{3:>12.4f}{4:>12.4f}"
+                         "{5:>12.4f}".format(stage, stats['count'],
+                                             stats['total'],
+                                             1e3 * stats['total'] /
+                                             stats['count'],
+                                             1e3 * stats['min'],
+                                             1e3 * stats['max']))
+        for duration, stats in self.profiles:
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats('cumulative').print_stats(n_lines)
+            lines.append("Profile of a {0:.4f}s evaluation:\n{1}"
+                         .format(duration, stream.getvalue()))
+        return '\n'.join(lines)